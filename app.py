@@ -1,12 +1,33 @@
 import os
+import fcntl
+
+# Cap BLAS/OpenMP threads before numpy and torch load: each gunicorn worker
+# gets its share of the cores instead of every worker spawning one per core.
+# Short single-sentence encodes stop scaling beyond about 8 threads.
+_THREADS_PER_WORKER = str(min(8, max(1, (os.cpu_count() or 1) // int(os.getenv('GUNICORN_WORKERS', '1')))))
+for _thread_var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+    os.environ.setdefault(_thread_var, _THREADS_PER_WORKER)
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+
+import gzip
+import atexit
+import brotli
+import orjson
+import re
+import queue
 import sys
 import logging
-from flask import Flask, render_template, request, jsonify, session
+import hashlib
+import threading
+from flask import Flask, Response, render_template, request, jsonify, session
 from dotenv import load_dotenv
 from utils.content_generator import ContentGenerator
-from utils.embeddings import EmbeddingModel
+from utils.embeddings import EmbeddingModel, embedding_precision
+from utils.embedding_cache import EmbeddingCache
 from utils.vectorstore import VectorStore
-from utils.rag import EducationalRAG
+from utils.rag import EducationalRAG, response_events
+from utils.semantic_cache import SemanticCache
+from utils.json_provider import OrjsonProvider
 
 load_dotenv()
 
@@ -34,6 +55,7 @@ logging.getLogger('transformers').setLevel(logging.WARNING)
 logging.getLogger('torch').setLevel(logging.WARNING)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')
 
 PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
@@ -53,7 +75,7 @@ GRADE_TOPIC_MAPPING = {
     }
 }
 
-def is_topic_appropriate_for_grade(topic, grade):
+def _check_topic_for_grade(topic, grade):
     if topic not in GRADE_TOPIC_MAPPING:
         return True, None
     
@@ -68,27 +90,115 @@ def is_topic_appropriate_for_grade(topic, grade):
     else:
         return True, f"This is an advanced topic for your grade level."
 
+# Every request checks a known topic against a school grade; answer from a
+# precomputed table and only evaluate the rules for anything outside it
+_TOPIC_GRADE_CHECKS = {
+    (topic, grade): _check_topic_for_grade(topic, grade)
+    for topic in GRADE_TOPIC_MAPPING
+    for grade in range(1, 13)
+}
+
+def is_topic_appropriate_for_grade(topic, grade):
+    result = _TOPIC_GRADE_CHECKS.get((topic, grade))
+    if result is None:
+        result = _check_topic_for_grade(topic, grade)
+    return result
+
 print("🚀 Starting Educational RAG System...")
 
 try:
-    embedding_model = EmbeddingModel(model_name='sentence-transformers/paraphrase-multilingual-mpnet-base-v2')
+    # Multilingual MiniLM: 384-dim vectors, roughly 3x faster to encode than mpnet-base
+    EMBEDDING_MODEL_NAME = os.getenv(
+        'EMBEDDING_MODEL_NAME',
+        'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+    )
+    # EMBEDDING_BACKEND=onnx with e.g. EMBEDDING_ONNX_FILE=onnx/model_qint8_avx512_vnni.onnx
+    # serves an int8 ONNX Runtime export on CPU
+    EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'torch')
+    EMBEDDING_ONNX_FILE = os.getenv('EMBEDDING_ONNX_FILE')
+    # Opt-in: fp16 on GPU, dynamic int8 on CPU; checked against fp32 at load
+    EMBEDDING_QUANTIZE = os.getenv('EMBEDDING_QUANTIZE', 'false').lower() == 'true'
+    embedding_cache = EmbeddingCache(
+        db_path=os.getenv('EMBEDDING_CACHE_PATH', '.cache/embeddings.db'),
+        # Quantized and full-precision vectors differ, so the precision is
+        # part of the key, e.g. '<model>:int8'
+        model_name=':'.join(filter(None, [EMBEDDING_MODEL_NAME, EMBEDDING_ONNX_FILE,
+                                          embedding_precision(EMBEDDING_BACKEND, EMBEDDING_QUANTIZE)])),
+        dtype=os.getenv('EMBEDDING_CACHE_DTYPE', 'float16'),
+        # e.g. the torch key ('<model>:fp32') after switching to its ONNX
+        # export: its cached query vectors are served while being re-embedded
+        migrate_from=os.getenv('EMBEDDING_CACHE_MIGRATE_FROM')
+    )
+    embedding_model = EmbeddingModel(
+        model_name=EMBEDDING_MODEL_NAME,
+        cache=embedding_cache,
+        backend=EMBEDDING_BACKEND,
+        onnx_file=EMBEDDING_ONNX_FILE,
+        quantize=EMBEDDING_QUANTIZE,
+        # e.g. 95: near-identical questions (typos) reuse a cached query embedding
+        fuzzy_threshold=float(os.environ['QUERY_FUZZY_THRESHOLD']) if os.getenv('QUERY_FUZZY_THRESHOLD') else None
+    )
+    
+    # Near-identical query embeddings with the same filter reuse the last
+    # Pinecone matches instead of another network round trip
+    def make_search_cache():
+        return SemanticCache(
+            max_entries=int(os.getenv('SEARCH_CACHE_SIZE', '2048')),
+            similarity_threshold=float(os.getenv('SEARCH_CACHE_SIMILARITY', '0.98'))
+        )
     
     vector_stores = {
         'math_index': VectorStore(
             api_key=PINECONE_API_KEY,
             environment=PINECONE_ENVIRONMENT,
             index_name='math-index',
-            dimension=768
+            dimension=embedding_model.embedding_dimension,
+            result_cache=make_search_cache()
         ),
         'science_index': VectorStore(
             api_key=PINECONE_API_KEY,
             environment=PINECONE_ENVIRONMENT,
             index_name='science-index',
-            dimension=768
+            dimension=embedding_model.embedding_dimension,
+            result_cache=make_search_cache()
         )
     }
     
-    rag = EducationalRAG(ANTHROPIC_API_KEY, vector_stores, embedding_model)
+    REDIS_URL = os.getenv('REDIS_URL')
+    if REDIS_URL:
+        # Shared across gunicorn workers so every worker benefits from each hit
+        from utils.redis_semantic_cache import RedisSemanticCache
+        response_cache = RedisSemanticCache(
+            REDIS_URL,
+            dimension=embedding_model.embedding_dimension,
+            similarity_threshold=float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.95')),
+            ttl_seconds=int(os.getenv('RESPONSE_CACHE_TTL', '86400'))
+        )
+    else:
+        response_cache = SemanticCache(
+            max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', '1024')),
+            similarity_threshold=float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0.95'))
+        )
+        # Warm-start from the answers cached by the previous process
+        RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', '.cache/response_cache.npz')
+        response_cache.load(RESPONSE_CACHE_PATH)
+        atexit.register(response_cache.save, RESPONSE_CACHE_PATH)
+    
+    # Optional curated FAQ answers: a JSON list of {"topic", "question",
+    # "answer"} objects, with "grades" limiting an answer to those grades
+    FAQ_PATH = os.getenv('FAQ_PATH', 'data/faqs.json')
+    faqs = None
+    if os.path.exists(FAQ_PATH):
+        with open(FAQ_PATH, 'rb') as f:
+            faqs = orjson.loads(f.read())
+    
+    rag = EducationalRAG(
+        ANTHROPIC_API_KEY,
+        vector_stores,
+        embedding_model,
+        response_cache=response_cache,
+        faqs=faqs
+    )
     content_generator = ContentGenerator()
     
     print("✅ Components initialized successfully")
@@ -101,7 +211,7 @@ GRADE_MAPPING = {
     'high_school': {'CBSE': [9, 10, 11, 12], 'ICSE': [9, 10, 11, 12], 'SSC': [9, 10, 11, 12]}
 }
 
-def get_level_from_grade(grade):
+def _level_for_grade(grade):
     if grade <= 5:
         return 'elementary'
     elif grade <= 8:
@@ -109,208 +219,394 @@ def get_level_from_grade(grade):
     else:
         return 'high_school'
 
-def initialize_knowledge_base():
-    try:
-        topics_config = {
-            'quadratic_equations': {
-                'index': 'math_index',
-                'namespace': 'algebra_quadratic_equations',
-                'subtopics': {
-                    'patterns_introduction': {
-                        'name': 'Patterns and Square Numbers',
-                        'sub_methods': ['visual_patterns', 'number_sequences']
-                    },
-                    'factorization_method': {
-                        'name': 'Solving by Factorization',
-                        'sub_methods': ['simple_factoring', 'splitting_middle_term', 'grouping']
-                    },
-                    'formula_method': {
-                        'name': 'Quadratic Formula',
-                        'sub_methods': ['derivation', 'application', 'discriminant_analysis']
-                    },
-                    'completing_square': {
-                        'name': 'Completing the Square',
-                        'sub_methods': ['geometric_interpretation', 'algebraic_method']
-                    },
-                    'applications': {
-                        'name': 'Real-world Applications',
-                        'sub_methods': ['physics_problems', 'optimization', 'geometry']
-                    }
-                }
+_LEVEL_BY_GRADE = {grade: _level_for_grade(grade) for grade in range(1, 13)}
+
+def get_level_from_grade(grade):
+    return _LEVEL_BY_GRADE.get(grade) or _level_for_grade(grade)
+
+# Single-pass content checks used while building knowledge-base chunks
+_EQUATION_CHARS_RE = re.compile('[²×÷+\\-=]')
+_MARATHI_WORDS_RE = re.compile('वर्ग|पचन|अवयव')
+_HINT_RE = re.compile(r'hint|tip', re.IGNORECASE)
+_SOLUTION_RE = re.compile(r'solution|example', re.IGNORECASE)
+
+# Set once background ingestion has finished (successfully or not) so the
+# RAG endpoints can stop answering 503 while the knowledge base is loading.
+knowledge_base_ready = threading.Event()
+
+def knowledge_base_initializing_response():
+    response = jsonify({
+        'error': 'Knowledge base is still initializing. Please retry shortly.',
+        'type': 'initializing'
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+TOPICS_CONFIG = {
+    'quadratic_equations': {
+        'index': 'math_index',
+        'namespace': 'algebra_quadratic_equations',
+        'subtopics': {
+            'patterns_introduction': {
+                'name': 'Patterns and Square Numbers',
+                'sub_methods': ['visual_patterns', 'number_sequences']
+            },
+            'factorization_method': {
+                'name': 'Solving by Factorization',
+                'sub_methods': ['simple_factoring', 'splitting_middle_term', 'grouping']
+            },
+            'formula_method': {
+                'name': 'Quadratic Formula',
+                'sub_methods': ['derivation', 'application', 'discriminant_analysis']
+            },
+            'completing_square': {
+                'name': 'Completing the Square',
+                'sub_methods': ['geometric_interpretation', 'algebraic_method']
+            },
+            'applications': {
+                'name': 'Real-world Applications',
+                'sub_methods': ['physics_problems', 'optimization', 'geometry']
+            }
+        }
+    },
+    'digestive_system': {
+        'index': 'science_index',
+        'namespace': 'biology_digestive_system',
+        'subtopics': {
+            'anatomy_structure': {
+                'name': 'Anatomical Structure',
+                'sub_methods': ['organs', 'tissues', 'cellular_structure']
+            },
+            'digestion_process': {
+                'name': 'Process of Digestion',
+                'sub_methods': ['mechanical_digestion', 'chemical_digestion', 'peristalsis']
             },
-            'digestive_system': {
-                'index': 'science_index',
-                'namespace': 'biology_digestive_system',
-                'subtopics': {
-                    'anatomy_structure': {
-                        'name': 'Anatomical Structure',
-                        'sub_methods': ['organs', 'tissues', 'cellular_structure']
-                    },
-                    'digestion_process': {
-                        'name': 'Process of Digestion',
-                        'sub_methods': ['mechanical_digestion', 'chemical_digestion', 'peristalsis']
-                    },
-                    'enzymes_secretions': {
-                        'name': 'Enzymes and Secretions',
-                        'sub_methods': ['digestive_enzymes', 'hormonal_control', 'pH_regulation']
-                    },
-                    'absorption_transport': {
-                        'name': 'Absorption and Transport',
-                        'sub_methods': ['villi_function', 'nutrient_transport', 'water_absorption']
-                    },
-                    'disorders_health': {
-                        'name': 'Disorders and Health',
-                        'sub_methods': ['common_disorders', 'prevention', 'dietary_management']
-                    }
-                }
+            'enzymes_secretions': {
+                'name': 'Enzymes and Secretions',
+                'sub_methods': ['digestive_enzymes', 'hormonal_control', 'pH_regulation']
+            },
+            'absorption_transport': {
+                'name': 'Absorption and Transport',
+                'sub_methods': ['villi_function', 'nutrient_transport', 'water_absorption']
+            },
+            'disorders_health': {
+                'name': 'Disorders and Health',
+                'sub_methods': ['common_disorders', 'prevention', 'dietary_management']
             }
         }
+    }
+}
+
+LEVELS = ['elementary', 'middle_school', 'high_school']
+BOARDS = ['CBSE', 'ICSE', 'SSC']
+
+# Lookup sets used to reject malformed requests before any RAG work
+VALID_GRADES = frozenset(
+    grade for boards in GRADE_MAPPING.values() for grades in boards.values() for grade in grades
+)
+VALID_SUBTOPICS = frozenset(
+    (topic_key, subtopic_key)
+    for topic_key, topic_config in TOPICS_CONFIG.items()
+    for subtopic_key in topic_config['subtopics']
+)
+
+def validate_question_request(topic, board, grade, subtopic=None):
+    """Return an error message for an invalid topic/board/grade/subtopic combination, else None."""
+    if topic not in TOPICS_CONFIG:
+        return f'Unknown topic: {topic}'
+    if board not in BOARDS:
+        return f'Unknown board: {board}'
+    if not isinstance(grade, int) or isinstance(grade, bool) or grade not in VALID_GRADES:
+        return f'Grade must be between {min(VALID_GRADES)} and {max(VALID_GRADES)}'
+    if subtopic and (topic, subtopic) not in VALID_SUBTOPICS:
+        return f'Unknown subtopic for {topic}: {subtopic}'
+    return None
+
+# Ingestion pipeline tuning: chunks per embedding call, texts per encode
+# batch within a length bucket, and bounded queue depth
+EMBED_BATCH_SIZE = 256
+ENCODE_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '32'))
+PIPELINE_QUEUE_SIZE = 4
+_PIPELINE_DONE = object()
+
+def _generate_topic_content(topic_key):
+    """Generated content for every (level, board) variant of a topic, in LEVELS x BOARDS order."""
+    return {
+        (level, board): content_generator.generate_content(topic_key, level, board)
+        for level in LEVELS
+        for board in BOARDS
+    }
+
+def _build_topic_chunks(topic_key, topic_config, generated):
+    """Yield knowledge-base chunks for every (level, board) variant of a topic."""
+    for (level, board), content_data in generated.items():
+        grades = GRADE_MAPPING[level][board]
         
-        levels = ['elementary', 'middle_school', 'high_school']
-        boards = ['CBSE', 'ICSE', 'SSC']
+        if not content_data:
+            continue
         
-        for topic_key, topic_config in topics_config.items():
-            vector_store = vector_stores[topic_config['index']]
-            namespace = topic_config['namespace']
+        for section_index, section in enumerate(content_data.get('sections', [])):
+            content = section['content']
+            subtopic_key, sub_method = _categorize_section_detailed(
+                section['title'], 
+                content, 
+                topic_config['subtopics']
+            )
             
-            existing_stats = vector_store.get_namespace_stats(namespace)
-            if existing_stats.get('vector_count', 0) > 0:
-                continue
+            content_type = _determine_content_type(content)
+            problem_complexity = _assess_complexity(content, level)
+            learning_stage = _determine_learning_stage(section['title'], content_type)
+            
+            method_tags, excluded_methods = _extract_method_info(
+                content, 
+                subtopic_key, 
+                level, 
+                board
+            )
             
-            all_chunks = []
+            language = 'english'
+            if board == 'SSC' and _MARATHI_WORDS_RE.search(content):
+                language = 'marathi'
             
-            for level in levels:
-                for board in boards:
-                    grades = GRADE_MAPPING[level][board]
-                    content_data = content_generator.generate_content(topic_key, level, board)
-                    
-                    if not content_data:
-                        continue
-                    
-                    for section in content_data.get('sections', []):
-                        subtopic_key, sub_method = _categorize_section_detailed(
-                            section['title'], 
-                            section['content'], 
-                            topic_config['subtopics']
-                        )
-                        
-                        content_type = _determine_content_type(section['content'])
-                        problem_complexity = _assess_complexity(section['content'], level)
-                        learning_stage = _determine_learning_stage(section['title'], content_type)
-                        
-                        method_tags, excluded_methods = _extract_method_info(
-                            section['content'], 
-                            subtopic_key, 
-                            level, 
-                            board
-                        )
-                        
-                        language = 'english'
-                        if board == 'SSC' and any(marathi_word in section['content'] for marathi_word in ['वर्ग', 'पचन', 'अवयव']):
-                            language = 'marathi'
-                        
-                        for grade in grades:
-                            import uuid
-                            chunk = {
-                                'text': section['content'],
-                                'content_id': f"{topic_key}_{subtopic_key}_{sub_method}_{uuid.uuid4().hex[:8]}",
-                                'topic': topic_key,
-                                'subtopic': subtopic_key,
-                                'sub_method': sub_method,
-                                'grade': grade,
-                                'board': board,
-                                'language': language,
-                                'difficulty_level': _map_difficulty_to_number(level, grade, grades),
-                                'estimated_time_minutes': _estimate_time(content_type, problem_complexity),
-                                'method_tags': method_tags,
-                                'excluded_methods': excluded_methods,
-                                'solution_approach': subtopic_key if 'method' in subtopic_key else 'conceptual',
-                                'learning_stage': learning_stage,
-                                'prerequisite_concepts': content_data.get('prerequisites', []),
-                                'learning_objectives': content_data.get('learning_objectives', []),
-                                'content_type': content_type,
-                                'problem_complexity': problem_complexity,
-                                'has_worked_solution': 'solution' in section['content'].lower() or 'example' in section['content'].lower(),
-                                'has_hints': 'hint' in section['content'].lower() or 'tip' in section['content'].lower(),
-                                'media_type': 'text_with_equations' if any(char in section['content'] for char in ['²', '×', '÷', '+', '-', '=']) else 'text_only'
-                            }
-                            all_chunks.append(chunk)
+            has_worked_solution = bool(_SOLUTION_RE.search(content))
+            has_hints = bool(_HINT_RE.search(content))
+            media_type = 'text_with_equations' if _EQUATION_CHARS_RE.search(content) else 'text_only'
             
-            if all_chunks:
-                embedded_chunks = embedding_model.embed_texts(all_chunks)
-                vector_store.add_documents(embedded_chunks, namespace)
+            # One chunk per section, tagged with every grade it applies to;
+            # queries filter on membership in 'grades'
+            yield {
+                'text': content,
+                # Deterministic, so a concurrent or repeated ingestion
+                # overwrites these vectors rather than adding duplicates
+                'content_id': f"{topic_key}_{subtopic_key}_{sub_method}_{level}_{board}_{section_index}",
+                'topic': topic_key,
+                'subtopic': subtopic_key,
+                'sub_method': sub_method,
+                'grades': [str(grade) for grade in grades],
+                'board': board,
+                'language': language,
+                'difficulty_level': _map_difficulty_to_number(level, grades[0], grades),
+                'difficulty_levels': [str(_map_difficulty_to_number(level, grade, grades)) for grade in grades],
+                'estimated_time_minutes': _estimate_time(content_type, problem_complexity),
+                'method_tags': method_tags,
+                'excluded_methods': excluded_methods,
+                'solution_approach': subtopic_key if 'method' in subtopic_key else 'conceptual',
+                'learning_stage': learning_stage,
+                'prerequisite_concepts': content_data.get('prerequisites', []),
+                'learning_objectives': content_data.get('learning_objectives', []),
+                'content_type': content_type,
+                'problem_complexity': problem_complexity,
+                'has_worked_solution': has_worked_solution,
+                'has_hints': has_hints,
+                'media_type': media_type
+            }
+
+def _topic_fingerprint(topic_config, generated):
+    """Hash everything that determines a topic's ingested vectors."""
+    payload = orjson.dumps(
+        [topic_config, embedding_model.model_name, embedding_model.precision, list(generated.values())],
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+def sse_response(events):
+    """Stream event dicts to the client as server-sent events."""
+    def generate():
+        for event in events:
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def initialize_knowledge_base():
+    """
+    Build, embed and upsert the knowledge base as a three-stage pipeline.
+    
+    Chunk building, embedding and Pinecone upserts run concurrently, connected
+    by bounded queues, so wall time approaches the slowest stage rather than
+    the sum of all three.
+    """
+    embed_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upsert_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # Namespaces with a failed batch never get their fingerprint recorded,
+    # so a partial ingestion is redone on the next start
+    failed_namespaces = set()
+    
+    def build_chunks():
+        try:
+            for topic_key, topic_config in TOPICS_CONFIG.items():
+                vector_store = vector_stores[topic_config['index']]
+                namespace = topic_config['namespace']
+                
+                # Generated once: it feeds both the fingerprint and the chunks
+                generated = _generate_topic_content(topic_key)
+                fingerprint = _topic_fingerprint(topic_config, generated)
+                try:
+                    stored_fingerprint = vector_store.get_fingerprint(namespace)
+                except Exception:
+                    # Unknown is not the same as changed: keep what is there
+                    # rather than wiping the namespace over a transient error
+                    logger.warning(f"Could not check '{topic_key}' for changes; leaving it as is")
+                    continue
+                if stored_fingerprint == fingerprint:
+                    logger.info(f"Knowledge base for '{topic_key}' is up to date")
+                    continue
+                
+                existing_stats = vector_store.get_namespace_stats(namespace)
+                if existing_stats.get('vector_count', 0) > 0:
+                    logger.info(f"Content for '{topic_key}' changed or was partially ingested; re-ingesting")
+                    vector_store.delete_namespace(namespace)
+                
+                batch = []
+                for chunk in _build_topic_chunks(topic_key, topic_config, generated):
+                    batch.append(chunk)
+                    if len(batch) >= EMBED_BATCH_SIZE:
+                        embed_queue.put((vector_store, namespace, batch))
+                        batch = []
+                if batch:
+                    embed_queue.put((vector_store, namespace, batch))
+                # A string in place of a batch marks the end of the topic
+                embed_queue.put((vector_store, namespace, fingerprint))
+        except Exception as e:
+            logger.error(f"Error building knowledge base chunks: {str(e)}")
+        finally:
+            embed_queue.put(_PIPELINE_DONE)
+    
+    def embed_chunks():
+        while True:
+            item = embed_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            vector_store, namespace, batch = item
+            if isinstance(batch, str):
+                upsert_queue.put(item)
+                continue
+            try:
+                embedded_chunks = embedding_model.embed_texts(batch, batch_size=ENCODE_BATCH_SIZE)
+                upsert_queue.put((vector_store, namespace, embedded_chunks))
+            except Exception as e:
+                failed_namespaces.add(namespace)
+                logger.error(f"Error embedding knowledge base chunks: {str(e)}")
+        upsert_queue.put(_PIPELINE_DONE)
+    
+    try:
+        upsert_batch_size = int(os.getenv('PINECONE_BATCH_SIZE', '100'))
+        
+        stages = [
+            threading.Thread(target=build_chunks, name='knowledge-base-build', daemon=True),
+            threading.Thread(target=embed_chunks, name='knowledge-base-embed', daemon=True)
+        ]
+        for stage in stages:
+            stage.start()
+        
+        while True:
+            item = upsert_queue.get()
+            if item is _PIPELINE_DONE:
+                break
+            vector_store, namespace, embedded_chunks = item
+            if isinstance(embedded_chunks, str):
+                if namespace not in failed_namespaces:
+                    vector_store.set_fingerprint(namespace, embedded_chunks)
+                continue
+            try:
+                if not vector_store.add_documents(embedded_chunks, namespace, batch_size=upsert_batch_size):
+                    failed_namespaces.add(namespace)
+            except Exception as e:
+                failed_namespaces.add(namespace)
+                logger.error(f"Error upserting knowledge base chunks: {str(e)}")
+        
+        for stage in stages:
+            stage.join()
                 
     except Exception as e:
         logger.error(f"Error initializing knowledge base: {str(e)}")
+    finally:
+        knowledge_base_ready.set()
 
-def _categorize_section_detailed(title, content, subtopics_config):
-    title_lower = title.lower()
-    content_lower = content.lower()
-    
-    categorization_rules = {
-        'patterns_introduction': {
-            'keywords': ['pattern', 'square number', 'sequence', 'वर्ग संख्या'],
-            'sub_methods': {
-                'visual_patterns': ['visual', 'arrange', 'dots', 'blocks'],
-                'number_sequences': ['sequence', 'series', 'differences']
-            }
-        },
-        'factorization_method': {
-            'keywords': ['factor', 'factorization', 'अवयव'],
-            'sub_methods': {
-                'simple_factoring': ['simple', 'basic factor'],
-                'splitting_middle_term': ['split', 'middle term'],
-                'grouping': ['group', 'grouping method']
-            }
-        },
-        'formula_method': {
-            'keywords': ['formula', 'quadratic formula', 'सूत्र'],
-            'sub_methods': {
-                'derivation': ['derive', 'proof'],
-                'application': ['apply', 'use formula'],
-                'discriminant_analysis': ['discriminant', 'nature of roots']
-            }
+CATEGORIZATION_RULES = {
+    'patterns_introduction': {
+        'keywords': ['pattern', 'square number', 'sequence', 'वर्ग संख्या'],
+        'sub_methods': {
+            'visual_patterns': ['visual', 'arrange', 'dots', 'blocks'],
+            'number_sequences': ['sequence', 'series', 'differences']
+        }
+    },
+    'factorization_method': {
+        'keywords': ['factor', 'factorization', 'अवयव'],
+        'sub_methods': {
+            'simple_factoring': ['simple', 'basic factor'],
+            'splitting_middle_term': ['split', 'middle term'],
+            'grouping': ['group', 'grouping method']
+        }
+    },
+    'formula_method': {
+        'keywords': ['formula', 'quadratic formula', 'सूत्र'],
+        'sub_methods': {
+            'derivation': ['derive', 'proof'],
+            'application': ['apply', 'use formula'],
+            'discriminant_analysis': ['discriminant', 'nature of roots']
         }
     }
-    
-    for subtopic, config in categorization_rules.items():
-        if subtopic in subtopics_config:
-            for keyword in config['keywords']:
-                if keyword in title_lower or keyword in content_lower:
-                    sub_method = 'general'
-                    if 'sub_methods' in config:
-                        for method, method_keywords in config['sub_methods'].items():
-                            if any(kw in content_lower for kw in method_keywords):
-                                sub_method = method
-                                break
-                    return subtopic, sub_method
+}
+
+def _keyword_search(*keywords):
+    """Compiled case-insensitive search for any of the given substrings."""
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords), re.IGNORECASE).search
+
+# Each rule's keyword list compiled into a single alternation, in rule order
+_CATEGORIZATION_MATCHERS = tuple(
+    (
+        subtopic,
+        _keyword_search(*config['keywords']),
+        tuple(
+            (method, _keyword_search(*method_keywords))
+            for method, method_keywords in config.get('sub_methods', {}).items()
+        )
+    )
+    for subtopic, config in CATEGORIZATION_RULES.items()
+)
+
+def _categorize_section_detailed(title, content, subtopics_config):
+    for subtopic, matches_keyword, sub_method_matchers in _CATEGORIZATION_MATCHERS:
+        if subtopic in subtopics_config and (matches_keyword(title) or matches_keyword(content)):
+            for method, matches_method in sub_method_matchers:
+                if matches_method(content):
+                    return subtopic, method
+            return subtopic, 'general'
     
     return 'general', 'general'
 
+# First matching rule wins, mirroring the original if/elif order
+CONTENT_TYPE_RULES = (
+    (_keyword_search('example:', 'solve:'), 'worked_example'),
+    (_keyword_search('problem:', 'exercise:'), 'practice_problem'),
+    (_keyword_search('definition:', 'what is'), 'concept_explanation'),
+    (_keyword_search('activity:', 'project:'), 'activity'),
+    (_keyword_search('theorem:', 'proof:'), 'theory')
+)
+
+_MIDDLE_SCHOOL_COMPLEX = _keyword_search('advanced', 'complex', 'difficult')
+_HIGH_SCHOOL_COMPLEX = _keyword_search('proof', 'derive', 'advanced')
+
 def _determine_content_type(content):
-    content_lower = content.lower()
-    if 'example:' in content_lower or 'solve:' in content_lower:
-        return 'worked_example'
-    elif 'problem:' in content_lower or 'exercise:' in content_lower:
-        return 'practice_problem'
-    elif 'definition:' in content_lower or 'what is' in content_lower:
-        return 'concept_explanation'
-    elif 'activity:' in content_lower or 'project:' in content_lower:
-        return 'activity'
-    elif 'theorem:' in content_lower or 'proof:' in content_lower:
-        return 'theory'
-    else:
-        return 'general_content'
+    for matches, content_type in CONTENT_TYPE_RULES:
+        if matches(content):
+            return content_type
+    return 'general_content'
 
 def _assess_complexity(content, level):
     if level == 'elementary':
         return 'simple'
     elif level == 'middle_school':
-        if any(term in content.lower() for term in ['advanced', 'complex', 'difficult']):
+        if _MIDDLE_SCHOOL_COMPLEX(content):
             return 'moderate_complex'
         return 'moderate_simple'
     else:
-        if any(term in content.lower() for term in ['proof', 'derive', 'advanced']):
+        if _HIGH_SCHOOL_COMPLEX(content):
             return 'complex'
         return 'moderate_complex'
 
@@ -327,98 +623,175 @@ def _determine_learning_stage(title, content_type):
     else:
         return 'learning'
 
+_HAS_QUADRATIC = _keyword_search('quadratic')
+_HAS_FACTOR = _keyword_search('factor')
+_HAS_FORMULA = _keyword_search('formula')
+_HAS_COMPLET = _keyword_search('complet')
+_HAS_SQUARE = _keyword_search('square')
+_HAS_DIGEST = _keyword_search('digest')
+_HAS_ENZYME = _keyword_search('enzyme')
+_HAS_MECHANICAL = _keyword_search('mechanical')
+_HAS_ABSORB = _keyword_search('absorb', 'absorption')
+
 def _extract_method_info(content, subtopic, level, board):
     method_tags = []
     excluded_methods = []
-    content_lower = content.lower()
     
-    if 'quadratic' in content_lower:
-        if 'factor' in content_lower:
+    if _HAS_QUADRATIC(content):
+        if _HAS_FACTOR(content):
             method_tags.append('factorization')
-        if 'formula' in content_lower and level == 'high_school':
-            method_tags.append('quadratic_formula')
-        elif 'formula' in content_lower and level != 'high_school':
-            excluded_methods.append('quadratic_formula')
-        if 'complet' in content_lower and 'square' in content_lower:
+        if _HAS_FORMULA(content):
+            if level == 'high_school':
+                method_tags.append('quadratic_formula')
+            else:
+                excluded_methods.append('quadratic_formula')
+        if _HAS_COMPLET(content) and _HAS_SQUARE(content):
             method_tags.append('completing_square')
     
-    if 'digest' in content_lower:
-        if 'enzyme' in content_lower:
+    if _HAS_DIGEST(content):
+        if _HAS_ENZYME(content):
             method_tags.append('enzymatic_process')
-        if 'mechanical' in content_lower:
+        if _HAS_MECHANICAL(content):
             method_tags.append('mechanical_process')
-        if 'absorb' in content_lower or 'absorption' in content_lower:
+        if _HAS_ABSORB(content):
             method_tags.append('absorption')
     
     return method_tags, excluded_methods
 
+BASE_DIFFICULTY = {
+    'elementary': 1,
+    'middle_school': 2,
+    'high_school': 3
+}
+
+# Difficulty for every (level, grade) pair in GRADE_MAPPING, precomputed so
+# the per-chunk lookup is a single dict access instead of a list.index scan
+DIFFICULTY_LOOKUP = {
+    (level, grade): min(5, BASE_DIFFICULTY[level] + position * 0.3)
+    for level, boards in GRADE_MAPPING.items()
+    for grades in boards.values()
+    for position, grade in enumerate(grades)
+}
+
+TIME_MATRIX = {
+    'concept_explanation': {'simple': 10, 'moderate_simple': 15, 'moderate_complex': 20, 'complex': 30},
+    'worked_example': {'simple': 15, 'moderate_simple': 20, 'moderate_complex': 25, 'complex': 35},
+    'practice_problem': {'simple': 10, 'moderate_simple': 15, 'moderate_complex': 20, 'complex': 25},
+    'activity': {'simple': 20, 'moderate_simple': 30, 'moderate_complex': 40, 'complex': 50},
+    'theory': {'simple': 15, 'moderate_simple': 25, 'moderate_complex': 35, 'complex': 45}
+}
+
+TIME_LOOKUP = {
+    (content_type, complexity): minutes
+    for content_type, by_complexity in TIME_MATRIX.items()
+    for complexity, minutes in by_complexity.items()
+}
+
 def _map_difficulty_to_number(level, grade, grade_range):
-    base_difficulty = {
-        'elementary': 1,
-        'middle_school': 2,
-        'high_school': 3
-    }
+    difficulty = DIFFICULTY_LOOKUP.get((level, grade))
+    if difficulty is not None:
+        return difficulty
+    
     grade_position = grade_range.index(grade) if grade in grade_range else 0
-    adjustment = grade_position * 0.3
-    return min(5, base_difficulty[level] + adjustment)
+    return min(5, BASE_DIFFICULTY[level] + grade_position * 0.3)
 
 def _estimate_time(content_type, complexity):
-    time_matrix = {
-        'concept_explanation': {'simple': 10, 'moderate_simple': 15, 'moderate_complex': 20, 'complex': 30},
-        'worked_example': {'simple': 15, 'moderate_simple': 20, 'moderate_complex': 25, 'complex': 35},
-        'practice_problem': {'simple': 10, 'moderate_simple': 15, 'moderate_complex': 20, 'complex': 25},
-        'activity': {'simple': 20, 'moderate_simple': 30, 'moderate_complex': 40, 'complex': 50},
-        'theory': {'simple': 15, 'moderate_simple': 25, 'moderate_complex': 35, 'complex': 45}
-    }
-    return time_matrix.get(content_type, {}).get(complexity, 15)
+    return TIME_LOOKUP.get((content_type, complexity), 15)
+
+KNOWLEDGE_BASE_LOCK_PATH = os.getenv('KNOWLEDGE_BASE_LOCK_PATH', '.cache/knowledge_base.lock')
+
+def _initialize_knowledge_base_locked():
+    """
+    Run initialize_knowledge_base in one process at a time on this host.
+    
+    Every gunicorn worker starts ingestion, and they queue on a file lock:
+    the first does the work and records each topic's fingerprint, the rest
+    (answering 503 meanwhile) then find every topic up to date, instead of
+    all deleting and re-embedding the same namespaces at once.
+    """
+    try:
+        os.makedirs(os.path.dirname(KNOWLEDGE_BASE_LOCK_PATH) or '.', exist_ok=True)
+        lock_file = open(KNOWLEDGE_BASE_LOCK_PATH, 'a')
+    except OSError as e:
+        logger.warning(f"Could not open {KNOWLEDGE_BASE_LOCK_PATH} ({e}); ingesting without the lock")
+        initialize_knowledge_base()
+        return
+    
+    # Closing the file releases the lock, also if this process dies
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        initialize_knowledge_base()
+
+def start_knowledge_base_initialization():
+    threading.Thread(
+        target=_initialize_knowledge_base_locked,
+        name='knowledge-base-init',
+        daemon=True
+    ).start()
 
-with app.app_context():
-    initialize_knowledge_base()
+# A preloading gunicorn master sets this and starts ingestion in each worker
+# after fork instead (see gunicorn.conf.py): threads don't survive fork
+if os.getenv('DEFER_KNOWLEDGE_BASE_INIT', 'false').lower() != 'true':
+    start_knowledge_base_initialization()
 
-print("✅ System ready! Visit http://localhost:5000")
+print("✅ System ready! Visit http://localhost:5000 (knowledge base loading in background)")
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/api/topics', methods=['GET'])
-def get_topics():
-    topics = {
-        'quadratic_equations': {
-            'name': 'Quadratic Equations',
-            'index': 'math_index',
-            'namespace': 'algebra_quadratic_equations',
-            'subtopics': {
-                'patterns_introduction': 'Patterns & Square Numbers',
-                'factorization_method': 'Factorization Methods',
-                'formula_method': 'Quadratic Formula',
-                'completing_square': 'Completing the Square',
-                'applications': 'Applications'
-            },
-            'grades': list(range(3, 13)),
-            'boards': ['CBSE', 'ICSE', 'SSC'],
-            'languages': ['english', 'hindi', 'marathi']
+TOPICS = {
+    'quadratic_equations': {
+        'name': 'Quadratic Equations',
+        'index': 'math_index',
+        'namespace': 'algebra_quadratic_equations',
+        'subtopics': {
+            'patterns_introduction': 'Patterns & Square Numbers',
+            'factorization_method': 'Factorization Methods',
+            'formula_method': 'Quadratic Formula',
+            'completing_square': 'Completing the Square',
+            'applications': 'Applications'
         },
-        'digestive_system': {
-            'name': 'Digestive System',
-            'index': 'science_index',
-            'namespace': 'biology_digestive_system',
-            'subtopics': {
-                'anatomy_structure': 'Anatomical Structure',
-                'digestion_process': 'Digestion Process',
-                'enzymes_secretions': 'Enzymes & Secretions',
-                'absorption_transport': 'Absorption & Transport',
-                'disorders_health': 'Health & Disorders'
-            },
-            'grades': list(range(3, 13)),
-            'boards': ['CBSE', 'ICSE', 'SSC'],
-            'languages': ['english', 'hindi', 'marathi']
-        }
+        'grades': list(range(3, 13)),
+        'boards': ['CBSE', 'ICSE', 'SSC'],
+        'languages': ['english', 'hindi', 'marathi']
+    },
+    'digestive_system': {
+        'name': 'Digestive System',
+        'index': 'science_index',
+        'namespace': 'biology_digestive_system',
+        'subtopics': {
+            'anatomy_structure': 'Anatomical Structure',
+            'digestion_process': 'Digestion Process',
+            'enzymes_secretions': 'Enzymes & Secretions',
+            'absorption_transport': 'Absorption & Transport',
+            'disorders_health': 'Health & Disorders'
+        },
+        'grades': list(range(3, 13)),
+        'boards': ['CBSE', 'ICSE', 'SSC'],
+        'languages': ['english', 'hindi', 'marathi']
     }
-    return jsonify(topics)
+}
+
+# /api/topics is static, so serialize and compress it once at import time
+TOPICS_JSON = orjson.dumps(TOPICS)
+TOPICS_JSON_ENCODED = {
+    'br': brotli.compress(TOPICS_JSON, quality=11),
+    'gzip': gzip.compress(TOPICS_JSON, compresslevel=9)
+}
+
+@app.route('/api/topics', methods=['GET'])
+def get_topics():
+    headers = {'Cache-Control': 'public, max-age=3600', 'Vary': 'Accept-Encoding'}
+    for encoding, body in TOPICS_JSON_ENCODED.items():
+        if encoding in request.accept_encodings:
+            headers['Content-Encoding'] = encoding
+            return Response(body, mimetype='application/json', headers=headers)
+    return Response(TOPICS_JSON, mimetype='application/json', headers=headers)
 
 @app.route('/api/chat', methods=['POST'])
-def chat():
+@app.route('/api/chat/stream', methods=['POST'], defaults={'force_stream': True})
+async def chat(force_stream=False):
     try:
         data = request.json
         message = data.get('message', '')
@@ -441,6 +814,19 @@ def chat():
                 'error': f'Missing required fields: {", ".join(missing_fields)}'
             }), 400
         
+        validation_error = validate_question_request(topic, board, grade, subtopic)
+        if validation_error:
+            return jsonify({'error': validation_error}), 400
+        
+        if not knowledge_base_ready.is_set():
+            return knowledge_base_initializing_response()
+        
+        wants_stream = (
+            force_stream
+            or bool(data.get('stream'))
+            or 'text/event-stream' in request.headers.get('Accept', '')
+        )
+        
         is_appropriate, grade_message = is_topic_appropriate_for_grade(topic, grade)
         
         if not is_appropriate:
@@ -453,12 +839,15 @@ Right now, you're in grade {grade}, so it's perfectly normal that this topic has
 
 Keep being curious about learning - that's wonderful! For now, you might want to focus on the topics that are part of your current grade curriculum. Is there anything else from your current studies that I can help you with?"""
             
-            return jsonify({
+            response = {
                 'answer': response_message,
                 'grade_appropriate': False,
                 'recommended_grade': GRADE_TOPIC_MAPPING[topic]['min_grade'],
                 'current_grade': grade
-            })
+            }
+            if wants_stream:
+                return sse_response(response_events(response))
+            return jsonify(response)
         
         level = get_level_from_grade(grade)
         
@@ -474,26 +863,22 @@ Keep being curious about learning - that's wonderful! For now, you might want to
         if method_preference:
             metadata_filter['method_tags'] = method_preference
         
-        response = rag.answer_educational_question(
+        if wants_stream:
+            def events():
+                for event in rag.answer_educational_question_stream(message, topic, metadata_filter, level):
+                    if event['type'] == 'metadata':
+                        event = {**event, 'grade_appropriate': True, 'grade_message': grade_message}
+                    yield event
+            
+            return sse_response(events())
+        
+        response = await rag.answer_educational_question_async(
             question=message,
             topic=topic,
             metadata_filter=metadata_filter,
             level=level
         )
         
-        if not response.get('content_metadata') or len(response.get('content_metadata', [])) == 0:
-            relaxed_filter = {
-                'grade': grade,
-                'board': board
-            }
-            
-            response = rag.answer_educational_question(
-                question=message,
-                topic=topic,
-                metadata_filter=relaxed_filter,
-                level=level
-            )
-        
         response['grade_appropriate'] = True
         response['grade_message'] = grade_message
         
@@ -510,6 +895,9 @@ Keep being curious about learning - that's wonderful! For now, you might want to
 
 @app.route('/api/adaptive-content', methods=['POST'])
 def get_adaptive_content():
+    if not knowledge_base_ready.is_set():
+        return knowledge_base_initializing_response()
+    
     try:
         data = request.json
         topic = data.get('topic', '')
@@ -521,6 +909,17 @@ def get_adaptive_content():
         if not topic:
             return jsonify({'error': 'Topic is required'}), 400
         
+        # grade reaches lru_cached helpers and numeric comparisons: accept
+        # "9" as 9, reject anything else up front
+        if not isinstance(grade, bool):
+            try:
+                grade = int(grade)
+            except (TypeError, ValueError):
+                pass
+        validation_error = validate_question_request(topic, board, grade, subtopic)
+        if validation_error:
+            return jsonify({'error': validation_error}), 400
+        
         is_appropriate, grade_message = is_topic_appropriate_for_grade(topic, grade)
         
         if not is_appropriate:
@@ -548,7 +947,7 @@ def get_adaptive_content():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/lesson', methods=['POST'])
-def generate_lesson():
+async def generate_lesson():
     try:
         data = request.json
         message = data.get('message', '')
@@ -570,6 +969,13 @@ def generate_lesson():
                 'error': f'Missing required fields: {", ".join(missing_fields)}'
             }), 400
         
+        validation_error = validate_question_request(topic, board, grade, subtopic)
+        if validation_error:
+            return jsonify({'error': validation_error}), 400
+        
+        if not knowledge_base_ready.is_set():
+            return knowledge_base_initializing_response()
+        
         is_appropriate, grade_message = is_topic_appropriate_for_grade(topic, grade)
         
         if not is_appropriate:
@@ -607,26 +1013,13 @@ Keep being curious about learning - that's wonderful! For now, you might want to
         if not message:
             message = f"Provide a comprehensive lesson on {topic.replace('_', ' ')} for grade {grade} {board} board students"
         
-        response = rag.answer_educational_question(
+        response = await rag.answer_educational_question_async(
             question=message,
             topic=topic,
             metadata_filter=metadata_filter,
             level=level
         )
         
-        if not response.get('content_metadata') or len(response.get('content_metadata', [])) == 0:
-            relaxed_filter = {
-                'grade': grade,
-                'board': board
-            }
-            
-            response = rag.answer_educational_question(
-                question=message,
-                topic=topic,
-                metadata_filter=relaxed_filter,
-                level=level
-            )
-        
         response['grade_appropriate'] = True
         response['grade_message'] = grade_message
         
@@ -674,4 +1067,5 @@ def get_learning_path():
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
-    app.run(debug=False, port=5000, use_reloader=False, threaded=True)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(debug=False, port=5000, use_reloader=False)
\ No newline at end of file
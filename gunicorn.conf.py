@@ -0,0 +1,46 @@
+import os
+
+# Production server: gunicorn app:app
+#
+# Each worker is a single-threaded sync process: encoding is CPU-bound torch
+# work, so scaling comes from processes, each with a small BLAS/OpenMP pool
+# (sized in app.py), rather than Python threads contending for the GIL and
+# for MKL's own threads.
+#
+# GUNICORN_PRELOAD=true loads the embedding model once in the master and
+# workers fork from it, sharing the weights copy-on-write. It is opt-in: the
+# master has then imported torch before forking. Knowledge-base ingestion
+# still starts in each worker after fork, so the master never waits on it and
+# workers answer 503 while it loads, as without preload; a file lock in
+# app.py lets one worker ingest while the others wait for it. Leave preload
+# off when serving the model on CUDA, which cannot be initialized before fork.
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', str(max(1, (os.cpu_count() or 1) // 2))))
+# Read by app.py to size each worker's BLAS/OpenMP thread pool
+os.environ['GUNICORN_WORKERS'] = str(workers)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))  # gevent workers only
+threads = int(os.getenv('GUNICORN_THREADS', '1'))  # gthread workers only
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+if preload_app:
+    # Read by app.py at import, which happens in the master
+    os.environ['DEFER_KNOWLEDGE_BASE_INIT'] = 'true'
+
+def when_ready(server):
+    """Freeze the preloaded app's objects before the first fork."""
+    if preload_app:
+        import gc
+        # Move everything loaded so far (model modules, tensors' Python
+        # wrappers, config) out of the collector's reach: GC passes in the
+        # workers would otherwise write to those object headers and
+        # un-share the pages holding them
+        gc.collect()
+        gc.freeze()
+
+def post_fork(server, worker):
+    """Start knowledge-base ingestion in each worker forked from a preloaded master."""
+    if preload_app:
+        import app
+        app.start_knowledge_base_initialization()
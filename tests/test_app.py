@@ -0,0 +1,129 @@
+import os
+import tempfile
+
+import pytest
+
+for module in ('flask', 'dotenv', 'brotli', 'torch', 'sentence_transformers', 'pinecone', 'anthropic'):
+    pytest.importorskip(module)
+
+# Keep the import from ingesting, and its caches out of the working tree
+_CACHE_DIR = tempfile.mkdtemp()
+os.environ['DEFER_KNOWLEDGE_BASE_INIT'] = 'true'
+os.environ.setdefault('EMBEDDING_CACHE_PATH', os.path.join(_CACHE_DIR, 'embeddings.db'))
+os.environ.setdefault('RESPONSE_CACHE_PATH', os.path.join(_CACHE_DIR, 'response_cache.npz'))
+
+import app
+from utils.content_generator import ContentGenerator
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self.vectors = {}
+        self.fingerprints = {}
+        self.fingerprint_error = None
+        self.deleted = []
+
+    def get_fingerprint(self, namespace):
+        if self.fingerprint_error:
+            raise self.fingerprint_error
+        return self.fingerprints.get(namespace)
+
+    def set_fingerprint(self, namespace, fingerprint):
+        self.fingerprints[namespace] = fingerprint
+
+    def get_namespace_stats(self, namespace=None):
+        return {'vector_count': len(self.vectors.get(namespace, {}))}
+
+    def delete_namespace(self, namespace):
+        self.deleted.append(namespace)
+        self.vectors.pop(namespace, None)
+
+    def add_documents(self, documents, namespace, batch_size=100):
+        for document in documents:
+            self.vectors.setdefault(namespace, {})[document['content_id']] = document
+        return True
+
+
+class FakeEmbeddingModel:
+    model_name = 'fake-model'
+    precision = 'fp32'
+
+    def embed_texts(self, texts, batch_size=64):
+        return [{**text, 'embedding': [1.0, 0.0]} for text in texts]
+
+
+@pytest.fixture
+def vector_store(monkeypatch):
+    store = FakeVectorStore()
+    monkeypatch.setattr(app, 'vector_stores', {'math_index': store, 'science_index': store}, raising=False)
+    monkeypatch.setattr(app, 'embedding_model', FakeEmbeddingModel(), raising=False)
+    monkeypatch.setattr(app, 'content_generator', ContentGenerator(), raising=False)
+    return store
+
+
+def ingest():
+    app.knowledge_base_ready.clear()
+    app.initialize_knowledge_base()
+    assert app.knowledge_base_ready.is_set()
+
+
+def test_unchanged_content_is_not_reingested(vector_store):
+    ingest()
+    namespaces = {config['namespace'] for config in app.TOPICS_CONFIG.values()}
+    assert set(vector_store.fingerprints) == namespaces
+    ingested = {namespace: dict(vectors) for namespace, vectors in vector_store.vectors.items()}
+
+    ingest()
+    assert vector_store.deleted == []
+    assert vector_store.vectors == ingested
+
+
+def test_fingerprint_lookup_error_leaves_namespaces_alone(vector_store):
+    ingest()
+    ingested = {namespace: set(vectors) for namespace, vectors in vector_store.vectors.items()}
+    vector_store.fingerprints.clear()
+    vector_store.fingerprint_error = RuntimeError('Pinecone unavailable')
+
+    ingest()
+    assert vector_store.deleted == []
+    assert {namespace: set(vectors) for namespace, vectors in vector_store.vectors.items()} == ingested
+
+
+def test_changed_content_is_replaced_under_the_same_ids(vector_store):
+    ingest()
+    ingested = {namespace: set(vectors) for namespace, vectors in vector_store.vectors.items()}
+    for namespace in vector_store.fingerprints:
+        vector_store.fingerprints[namespace] = 'stale'
+
+    ingest()
+    assert sorted(vector_store.deleted) == sorted(ingested)
+    assert {namespace: set(vectors) for namespace, vectors in vector_store.vectors.items()} == ingested
+
+
+class FakeRAG:
+    def __init__(self):
+        self.filters = []
+
+    def get_adaptive_content(self, topic, metadata_filter):
+        self.filters.append(metadata_filter)
+        return {'adaptive_content': []}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'rag', FakeRAG(), raising=False)
+    app.knowledge_base_ready.set()
+    return app.app.test_client()
+
+
+def test_adaptive_content_accepts_a_numeric_string_grade(client):
+    response = client.post('/api/adaptive-content', json={'topic': 'quadratic_equations', 'grade': '10'})
+    assert response.status_code == 200
+    assert app.rag.filters[0]['grade'] == 10
+
+
+@pytest.mark.parametrize('grade', [[9], 'nine', None, True, 99])
+def test_adaptive_content_rejects_invalid_grades(client, grade):
+    response = client.post('/api/adaptive-content', json={'topic': 'quadratic_equations', 'grade': grade})
+    assert response.status_code == 400
+    assert app.rag.filters == []
@@ -0,0 +1,200 @@
+import os
+import signal
+import sqlite3
+
+import pytest
+
+from utils.progress_tracker import SQLiteProgressTracker
+
+# Schema written by trackers from before mastery_level became a generated
+# column
+LEGACY_SCHEMA = '''
+    CREATE TABLE students (
+        student_id TEXT PRIMARY KEY,
+        grade INTEGER,
+        board TEXT,
+        language TEXT DEFAULT 'english',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        total_questions INTEGER DEFAULT 0,
+        total_correct INTEGER DEFAULT 0,
+        total_time_minutes INTEGER DEFAULT 0
+    );
+    CREATE TABLE interactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id TEXT,
+        content_id TEXT,
+        topic TEXT,
+        subtopic TEXT,
+        success BOOLEAN,
+        time_taken INTEGER DEFAULT 0,
+        error_type TEXT,
+        difficulty_level INTEGER,
+        method_tags TEXT,
+        question_text TEXT,
+        user_answer TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (student_id) REFERENCES students (student_id)
+    );
+    CREATE TABLE topic_mastery (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id TEXT,
+        topic TEXT,
+        total_attempts INTEGER DEFAULT 0,
+        correct_attempts INTEGER DEFAULT 0,
+        total_time INTEGER DEFAULT 0,
+        mastery_level REAL DEFAULT 0.0,
+        last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (student_id) REFERENCES students (student_id),
+        UNIQUE(student_id, topic)
+    );
+    CREATE TABLE subtopic_mastery (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id TEXT,
+        topic TEXT,
+        subtopic TEXT,
+        attempts INTEGER DEFAULT 0,
+        correct INTEGER DEFAULT 0,
+        mastery_level REAL DEFAULT 0.0,
+        last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (student_id) REFERENCES students (student_id),
+        UNIQUE(student_id, topic, subtopic)
+    );
+'''
+
+
+@pytest.fixture
+def tracker(request, tmp_path):
+    """A tracker on a fresh database; indirect params are constructor kwargs"""
+    tracker = SQLiteProgressTracker(db_path=str(tmp_path / 'progress.db'), **getattr(request, 'param', {}))
+    yield tracker
+    tracker.close()
+
+
+def query(tracker, sql, params=()):
+    with tracker.get_db_connection() as conn:
+        return [tuple(row) for row in conn.execute(sql, params).fetchall()]
+
+
+@pytest.fixture
+def legacy_database(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'progress.db'))
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executescript('''
+        INSERT INTO students (student_id, grade, board) VALUES ('s1', 9, 'CBSE');
+        INSERT INTO interactions (student_id, topic, success, time_taken, timestamp)
+        VALUES ('s1', 'algebra', 1, 4, '2024-01-02 10:00:00');
+        INSERT INTO topic_mastery (student_id, topic, total_attempts, correct_attempts, mastery_level)
+        VALUES ('s1', 'algebra', 4, 3, 0.75), ('ghost', 'geometry', 2, 1, 0.5);
+        INSERT INTO subtopic_mastery (student_id, topic, subtopic, attempts, correct, mastery_level)
+        VALUES ('ghost', 'geometry', 'angles', 2, 2, 1.0);
+    ''')
+    conn.commit()
+    conn.close()
+
+
+# legacy_database comes first so the tracker opens the database it wrote
+def test_legacy_database_is_rebuilt_keeping_orphan_rows(legacy_database, tracker):
+    assert query(tracker, 'SELECT student_id, topic, mastery_level FROM topic_mastery ORDER BY id') == [
+        ('s1', 'algebra', 0.75), ('ghost', 'geometry', 0.5)
+    ]
+    assert query(tracker, 'SELECT student_id, mastery_level FROM subtopic_mastery') == [('ghost', 1.0)]
+    # mastery_level is now generated, and the rebuild left nothing behind
+    assert not SQLiteProgressTracker._has_stored_mastery_level(tracker._write_conn.cursor(), 'topic_mastery')
+    assert query(tracker, "SELECT name FROM sqlite_master WHERE name LIKE '%legacy%'") == []
+    # The daily rollup is backfilled from existing interactions
+    assert query(tracker, 'SELECT student_id, day, hour, questions, correct, total_time FROM student_daily_stats') == [
+        ('s1', '2024-01-02', 10, 1, 1, 4)
+    ]
+
+
+def test_triggers_maintain_student_totals_and_daily_rollup(tracker):
+    tracker.create_or_update_student('s1', 9, 'CBSE')
+    tracker.record_interaction('s1', 'c1', 'algebra', True, subtopic='linear', time_taken=3, difficulty_level=2)
+    tracker.record_interactions_bulk([
+        {'student_id': 's1', 'content_id': 'c2', 'topic': 'algebra', 'success': False,
+         'time_taken': 5, 'error_type': 'sign', 'difficulty_level': 2},
+        {'student_id': 's1', 'content_id': 'c3', 'topic': 'geometry', 'success': True, 'time_taken': None},
+    ])
+
+    assert query(tracker, 'SELECT total_questions, total_correct, total_time_minutes FROM students') == [(3, 2, 8)]
+    assert query(tracker, '''
+        SELECT SUM(questions), SUM(correct), SUM(total_time) FROM student_daily_stats WHERE student_id = 's1'
+    ''') == [(3, 2, 8)]
+    assert query(tracker, '''
+        SELECT difficulty_level, SUM(questions) FROM student_daily_stats GROUP BY 1 ORDER BY 1
+    ''') == [(-1, 1), (2, 2)]
+    assert query(tracker, 'SELECT topic, total_attempts, correct_attempts, mastery_level FROM topic_mastery '
+                          'ORDER BY topic') == [('algebra', 2, 1, 0.5), ('geometry', 1, 1, 1.0)]
+    assert query(tracker, 'SELECT topic, error_type, frequency FROM error_patterns') == [('algebra', 'sign', 1)]
+
+
+@pytest.mark.parametrize('tracker', [{'flush_interval': 0.5}, {'flush_interval': 0.5, 'in_memory': True}],
+                         indirect=True, ids=['disk', 'in_memory'])
+def test_reads_reflect_queued_interactions(tracker):
+    tracker.create_or_update_student('s1', 9, 'CBSE')
+    tracker.enqueue_interaction('s1', 'c1', 'algebra', True, time_taken=2)
+    tracker.enqueue_interaction('s1', 'c2', 'algebra', False, time_taken=2)
+
+    assert tracker.get_student_mastery('s1', 'algebra') == 0.5
+    summary = tracker.get_student_progress_summary('s1')
+    assert summary['overall_stats']['total_questions'] == 2
+
+
+@pytest.mark.parametrize('tracker', [{'flush_interval': 0.5}], indirect=True)
+def test_end_learning_session_counts_queued_interactions(tracker):
+    tracker.create_or_update_student('s1', 9, 'CBSE')
+    # Interactions are matched to the session by timestamp, which has
+    # one-second resolution
+    tracker._write_conn.execute(
+        "INSERT INTO learning_sessions (student_id, session_start) VALUES ('s1', datetime('now', '-1 minute'))"
+    )
+    session_id = query(tracker, 'SELECT id FROM learning_sessions')[0][0]
+    tracker.enqueue_interaction('s1', 'c1', 'algebra', True, time_taken=2)
+    tracker.enqueue_interaction('s1', 'c2', 'algebra', True, time_taken=3)
+
+    assert tracker.end_learning_session(session_id, ['algebra'])
+    assert query(tracker, 'SELECT questions_attempted, questions_correct, total_time_minutes FROM learning_sessions') == [
+        (2, 2, 5)
+    ]
+
+
+@pytest.mark.parametrize('tracker', [{'flush_interval': 0.5}], indirect=True)
+def test_failing_record_does_not_drop_its_batch(tracker):
+    tracker.create_or_update_student('s1', 9, 'CBSE')
+    tracker.enqueue_interaction('s1', 'c1', 'algebra', True, time_taken=None)
+    tracker.enqueue_interaction('s1', 'c2', 'algebra', True, method_tags=[object()])
+    tracker.enqueue_interaction('unknown', 'c3', 'algebra', True)
+    tracker.enqueue_interaction('s1', 'c4', 'algebra', False, time_taken=3)
+    tracker.flush()
+
+    # Interactions for students without a profile row are kept
+    assert query(tracker, 'SELECT content_id FROM interactions ORDER BY id') == [('c1',), ('c3',), ('c4',)]
+    assert query(tracker, 'SELECT total_questions, total_time_minutes FROM students') == [(2, 3)]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+@pytest.mark.parametrize('tracker', [{'flush_interval': 0.05}, {'flush_interval': 0.05, 'in_memory': True}],
+                         indirect=True, ids=['disk', 'in_memory'])
+def test_forked_child_writes_and_flushes(tracker):
+    tracker.create_or_update_student('s1', 9, 'CBSE')
+    for _ in range(20):
+        tracker.enqueue_interaction('s1', 'parent', 'algebra', True)
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            # A flush that never returns kills the child instead of the run
+            signal.alarm(10)
+            tracker.enqueue_interaction('s1', 'child', 'algebra', True)
+            tracker.flush()
+            if query(tracker, "SELECT COUNT(*) FROM interactions WHERE content_id = 'child'") == [(1,)]:
+                status = 0
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    tracker.flush()
+    assert query(tracker, "SELECT COUNT(*) FROM interactions WHERE content_id = 'parent'") == [(20,)]
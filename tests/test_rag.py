@@ -0,0 +1,136 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('anthropic')
+pytest.importorskip('httpx')
+
+from utils.rag import CHARS_PER_TOKEN, CLAUDE_UNAVAILABLE_ANSWER, EducationalRAG
+from utils.semantic_cache import SemanticCache
+
+FILTER = {'grade': 9, 'board': 'CBSE'}
+
+
+class FakeEmbeddingModel:
+    def embed_query(self, query):
+        return [1.0, 0.0, 0.0]
+
+    def embed_queries(self, queries):
+        return [self.embed_query(query) for query in queries]
+
+
+class FakeVectorStore:
+    def __init__(self):
+        self.searches = 0
+
+    def similarity_search(self, query_embedding, namespace, top_k, filter):
+        self.searches += 1
+        return [{'text': 'Factorise by splitting the middle term.', 'content_id': 'c1', 'grades': ['9'],
+                 'method_tags': ['factorization'], 'content_type': 'explanation'}]
+
+
+class FakeClaude:
+    """messages.create raises while failing is set, else answers"""
+
+    def __init__(self):
+        self.failing = False
+        self.calls = 0
+        self.messages = self
+
+    def create(self, **request):
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError('overloaded')
+        return SimpleNamespace(content=[SimpleNamespace(text='Split the middle term.')])
+
+
+@pytest.fixture
+def claude(monkeypatch):
+    client = FakeClaude()
+    monkeypatch.setattr(EducationalRAG, '_create_client', lambda self: client)
+    return client
+
+
+@pytest.fixture
+def vector_store():
+    return FakeVectorStore()
+
+
+@pytest.fixture
+def rag(claude, vector_store):
+    return EducationalRAG('test-key', {'math_index': vector_store}, FakeEmbeddingModel(),
+                          response_cache=SemanticCache())
+
+
+def test_failed_claude_call_is_not_cached(rag, claude):
+    claude.failing = True
+    response = rag.answer_educational_question('How do I factorise?', 'quadratic_equations', FILTER)
+    assert response['answer'] == CLAUDE_UNAVAILABLE_ANSWER
+    assert 'error' in response
+
+    claude.failing = False
+    response = rag.answer_educational_question('How do I factorise?', 'quadratic_equations', FILTER)
+    assert response['answer'] == 'Split the middle term.'
+    assert claude.calls == 2
+
+
+def test_failed_async_claude_call_is_not_cached(rag, claude):
+    claude.failing = True
+    response = asyncio.run(rag.answer_educational_question_async('How do I factorise?', 'quadratic_equations', FILTER))
+    assert response['answer'] == CLAUDE_UNAVAILABLE_ANSWER
+
+    claude.failing = False
+    response = asyncio.run(rag.answer_educational_question_async('How do I factorise?', 'quadratic_equations', FILTER))
+    assert response['answer'] == 'Split the middle term.'
+
+
+def test_answers_are_cached(rag, claude):
+    rag.answer_educational_question('How do I factorise?', 'quadratic_equations', FILTER)
+    response = rag.answer_educational_question('How do I factorise?', 'quadratic_equations', FILTER)
+    assert response['answer'] == 'Split the middle term.'
+    assert claude.calls == 1
+
+
+def test_answer_many_reports_an_embedding_failure_per_question(rag, monkeypatch):
+    def fail(queries):
+        raise RuntimeError('model unavailable')
+
+    monkeypatch.setattr(rag.embedding_model, 'embed_queries', fail)
+    responses = rag.answer_many([
+        ('How do I factorise?', 'quadratic_equations', FILTER, None),
+        ('What is the discriminant?', 'quadratic_equations', FILTER, None),
+        ('How do I factorise?', 'quadratic_equations', FILTER, None),
+        ('Anything', 'unknown_topic', FILTER, None),
+    ])
+
+    assert [response.get('error') for response in responses] == [
+        'model unavailable', 'model unavailable', 'model unavailable', 'Invalid topic'
+    ]
+
+
+def test_answer_many_answers_repeats_once(claude, vector_store):
+    # Without a response cache, only deduplication saves the repeat
+    rag = EducationalRAG('test-key', {'math_index': vector_store}, FakeEmbeddingModel())
+    responses = rag.answer_many([
+        ('How do I factorise?', 'quadratic_equations', FILTER, None),
+        ('How do I factorise?', 'quadratic_equations', FILTER, None),
+        ('How do I factorise?', 'quadratic_equations', {'grade': 10, 'board': 'CBSE'}, None),
+    ])
+
+    assert claude.calls == 2
+    assert [response['answer'] for response in responses] == ['Split the middle term.'] * 3
+    assert responses[0] == responses[1]
+    assert responses[0] is not responses[1]
+
+
+def test_context_is_cut_to_the_token_budget(claude, vector_store):
+    rag = EducationalRAG('test-key', {'math_index': vector_store}, FakeEmbeddingModel(), context_token_budget=10)
+    budget = 10 * CHARS_PER_TOKEN
+    results = [{'text': 'a' * 30, 'content_id': 'best'}, {'text': 'b' * 30, 'content_id': 'second'},
+               {'text': 'c' * 30, 'content_id': 'third'}]
+
+    context, content_metadata = rag._build_context(results)
+    # The best match is kept whole, the next is truncated and the rest dropped
+    assert context == 'a' * 30 + '\n\n' + 'b' * (budget - 30)
+    assert [metadata['content_id'] for metadata in content_metadata] == ['best', 'second']
@@ -0,0 +1,36 @@
+from utils.semantic_cache import SemanticCache, query_numbers
+
+FILTER_KEY = SemanticCache.make_filter_key('quadratic_equations', {'grade': 9, 'board': 'CBSE'})
+
+
+def test_query_numbers():
+    assert query_numbers('solve x^2 - 5x + 6 = 0') == ('^', '2', '-', '5', '+', '6', '=', '0')
+    assert query_numbers('what is a quadratic equation') == ()
+
+
+def test_similar_question_with_different_numbers_misses():
+    cache = SemanticCache(similarity_threshold=0.95)
+    cache.put('solve x^2 - 5x + 6 = 0', [1.0, 0.0, 0.0], FILTER_KEY, {'answer': 'x = 2 or x = 3'})
+
+    assert cache.get_similar([1.0, 0.01, 0.0], FILTER_KEY, 'solve x^2 - 5x + 8 = 0') is None
+    assert cache.get_similar([1.0, 0.01, 0.0], FILTER_KEY, 'Solve: x^2 - 5x + 6 = 0')['answer'] == 'x = 2 or x = 3'
+
+
+def test_similar_question_with_other_filter_misses():
+    cache = SemanticCache(similarity_threshold=0.95)
+    cache.put('what is digestion', [1.0, 0.0, 0.0], FILTER_KEY, {'answer': 'Breaking down food.'})
+
+    other_filter = SemanticCache.make_filter_key('quadratic_equations', {'grade': 10, 'board': 'CBSE'})
+    assert cache.get_similar([1.0, 0.0, 0.0], other_filter, 'what is digestion') is None
+
+
+def test_semantic_tier_survives_save_and_load(tmp_path):
+    cache = SemanticCache(similarity_threshold=0.95)
+    cache.put('solve x^2 - 5x + 6 = 0', [1.0, 0.0, 0.0], FILTER_KEY, {'answer': 'x = 2 or x = 3'})
+    path = str(tmp_path / 'cache.npz')
+    assert cache.save(path)
+
+    restored = SemanticCache(similarity_threshold=0.95)
+    assert restored.load(path)
+    assert restored.get_similar([1.0, 0.0, 0.0], FILTER_KEY, 'solve x^2-5x+6=0')['answer'] == 'x = 2 or x = 3'
+    assert restored.get_similar([1.0, 0.0, 0.0], FILTER_KEY, 'solve x^2-5x+8=0') is None
@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache:
+    def __init__(self, db_path: str = ".cache/embeddings.db", model_name: str = "",
+                 dtype: str = "float16", migrate_from: Optional[str] = None):
+        """
+        Persistent embedding cache keyed on a hash of the embedded text.
+
+        Args:
+            db_path: Path of the SQLite file backing the cache
+            model_name: Embedding model the cached vectors belong to
+            dtype: On-disk precision; float16 halves the file and is ample for
+                   unit-length vectors compared by cosine similarity
+            migrate_from: Previous model whose vectors share this model's vector
+                          space (e.g. the torch weights behind a new ONNX export),
+                          optionally suffixed with its '@dtype'; its rows are
+                          served by get_stale until re-embedded
+        """
+        self.db_path = db_path
+        self.dtype = np.dtype(dtype)
+        # Rows written at another precision are simply never matched
+        self.model_name = f"{model_name}@{self.dtype.name}"
+
+        self.stale_model_name = None
+        self.stale_dtype = None
+        if migrate_from:
+            name, _, stale_dtype = migrate_from.partition('@')
+            self.stale_dtype = np.dtype(stale_dtype or self.dtype)
+            self.stale_model_name = f"{name}@{self.stale_dtype.name}"
+            if self.stale_model_name == self.model_name:
+                self.stale_model_name = None
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.init_database()
+
+    @contextmanager
+    def get_db_connection(self):
+        """Context manager for database connections"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            yield conn
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Embedding cache error: {e}")
+            raise
+        finally:
+            conn.close()
+
+    def init_database(self):
+        """Create the cache table if it does not exist yet"""
+        with self.get_db_connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_name TEXT,
+                    text_hash TEXT,
+                    embedding BLOB,
+                    PRIMARY KEY (model_name, text_hash)
+                )
+            ''')
+            conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        """Stable content hash used as the cache key for a text."""
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up cached embeddings for several texts.
+
+        Args:
+            texts: Text strings to look up
+
+        Returns:
+            Dictionary mapping each cached text to its float32 embedding
+        """
+        return self._lookup(self.model_name, self.dtype, texts)
+
+    def get_stale(self, texts: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up embeddings cached for the model being migrated from.
+
+        Args:
+            texts: Text strings missing from the current model's cache
+
+        Returns:
+            Dictionary mapping each text to its previous-model float32 embedding
+        """
+        if self.stale_model_name is None:
+            return {}
+        return self._lookup(self.stale_model_name, self.stale_dtype, texts)
+
+    def _lookup(self, model_name: str, dtype: np.dtype, texts: Iterable[str]) -> Dict[str, np.ndarray]:
+        hashes = {self.text_hash(text): text for text in texts}
+        if not hashes:
+            return {}
+
+        found = {}
+        try:
+            with self.get_db_connection() as conn:
+                keys = list(hashes)
+                # Stay well below SQLite's bound-parameter limit
+                for i in range(0, len(keys), 500):
+                    batch = keys[i:i + 500]
+                    placeholders = ','.join('?' * len(batch))
+                    rows = conn.execute(f'''
+                        SELECT text_hash, embedding FROM embeddings
+                        WHERE model_name = ? AND text_hash IN ({placeholders})
+                    ''', (model_name, *batch))
+                    for text_hash, blob in rows:
+                        found[hashes[text_hash]] = np.frombuffer(blob, dtype=dtype).astype(np.float32)
+        except Exception as e:
+            logger.error(f"Error reading embedding cache: {str(e)}")
+            return {}
+
+        return found
+
+    def set_many(self, embeddings: Dict[str, np.ndarray]) -> bool:
+        """
+        Store embeddings for several texts.
+
+        Args:
+            embeddings: Dictionary mapping text to its embedding
+        """
+        if not embeddings:
+            return True
+
+        rows = [
+            (self.model_name, self.text_hash(text), np.asarray(embedding, dtype=self.dtype).tobytes())
+            for text, embedding in embeddings.items()
+        ]
+
+        try:
+            with self.get_db_connection() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO embeddings (model_name, text_hash, embedding)
+                    VALUES (?, ?, ?)
+                ''', rows)
+                if self.stale_model_name is not None:
+                    # A re-embedded text no longer needs its previous-model row,
+                    # so the old model's entries drain as they are replaced
+                    conn.executemany('''
+                        DELETE FROM embeddings WHERE model_name = ? AND text_hash = ?
+                    ''', [(self.stale_model_name, text_hash) for _, text_hash, _ in rows])
+                conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error writing embedding cache: {str(e)}")
+            return False
@@ -1,36 +1,155 @@
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Any
+import torch
+from typing import List, Dict, Any, Optional
+from collections import OrderedDict, defaultdict
+import os
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from utils.embedding_cache import EmbeddingCache
+from utils.semantic_cache import query_numbers
 
 logger = logging.getLogger(__name__)
 
+# Token-length bucket boundaries used to group texts of similar length so
+# each encode batch is padded to a similar sequence length
+LENGTH_BUCKETS = np.array([32, 64, 128, 256, 512])
+
+# Reference batch for checking a quantized model against its full-precision
+# embeddings: plain prose, maths with numbers, and Devanagari
+QUANTIZATION_CHECK_TEXTS = [
+    "What is the digestive system and how does it work?",
+    "Solve x^2 - 5x + 6 = 0 by splitting the middle term.",
+    "Find the discriminant of 2x^2 + 3x - 7 = 0 and describe the nature of its roots.",
+    "द्विघात समीकरण के मूल कैसे ज्ञात करें?",
+]
+
+def embedding_precision(backend: str = 'torch', quantize: bool = False,
+                        device: Optional[str] = None) -> Optional[str]:
+    """
+    Precision EmbeddingModel runs at with these arguments: 'int8', 'fp16' or 'fp32'.
+    Vectors differ between them, so it belongs in every key they are cached
+    under. None for ONNX exports, whose file name already says.
+    """
+    if backend == 'onnx':
+        return None
+    if not quantize:
+        return 'fp32'
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    return 'fp16' if device.startswith('cuda') else 'int8'
+
+def normalize_query(query: str) -> str:
+    """Query-cache key: case, runs of whitespace and end punctuation don't change the question."""
+    return ' '.join(query.lower().split()).rstrip('?!. ')
+
 class EmbeddingModel:
-    def __init__(self, model_name: str = 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'):
+    def __init__(self, model_name: str = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2',
+                 cache: Optional[EmbeddingCache] = None, device: Optional[str] = None,
+                 quantize: bool = False, backend: str = 'torch', onnx_file: Optional[str] = None,
+                 query_cache_size: int = 4096, fuzzy_threshold: Optional[float] = None,
+                 quantize_min_similarity: float = 0.98):
         """
         Initialize the embedding model.
         
         Args:
             model_name: Name of the sentence-transformers model to use
-                       Default: 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2' (768 dimensions)
+                       Default: 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2' (384 dimensions)
+            cache: Optional persistent cache used to skip re-embedding known texts
+            device: Device to run on (default: 'cuda' when available, else 'cpu')
+            quantize: Run in fp16 on GPU or with dynamic int8 Linear layers on CPU
+            quantize_min_similarity: Lowest cosine similarity between quantized and
+                                     full-precision embeddings of a reference batch
+                                     before a warning is logged
+            backend: 'torch' or 'onnx' (ONNX Runtime, e.g. an int8 export for CPU)
+            onnx_file: ONNX file inside the model repo, e.g. 'onnx/model_qint8_avx512_vnni.onnx'
+            query_cache_size: Number of recent query embeddings kept in memory
+            fuzzy_threshold: When set, a query whose normalized text scores at least
+                             this rapidfuzz ratio (0-100) against a cached one, e.g.
+                             a one-letter typo in a long question, reuses its embedding;
+                             their numbers and operators must match exactly
         """
+        self.model_name = model_name
+        self.cache = cache
+        # LRU of query embeddings: repeated queries (and templated ones like
+        # the adaptive-content prompt) skip the forward pass
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.fuzzy_threshold = fuzzy_threshold
+        if fuzzy_threshold is not None:
+            # Cached keys grouped by their numbers and operators: a fuzzy
+            # lookup only scores the keys it could match
+            self._fuzzy_buckets = defaultdict(dict)
+            from rapidfuzz import fuzz, process
+            self._fuzzy_scorer = fuzz.ratio
+            self._fuzzy_extract = process.extractOne
+        # While migrating from a previous model, its cached query vectors are
+        # served immediately and re-embedded with this model in the background
+        self._backfill_executor = None
+        if cache is not None and cache.stale_model_name is not None:
+            self._reset_backfill_executor()
+            os.register_at_fork(after_in_child=self._reset_backfill_executor)
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.precision = embedding_precision(backend, quantize, self.device)
+        
+        if self.device == 'cpu':
+            # Encodes run one model call at a time; intra-op threads (sized by
+            # OMP_NUM_THREADS) do the work, extra inter-op threads only contend
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                pass  # already fixed once torch has run parallel work
+        
         try:
-            self.model = SentenceTransformer(model_name)
+            if backend == 'onnx':
+                # Exported ONNX files are quantized ahead of time, not here
+                self.model = SentenceTransformer(
+                    model_name, device=self.device, backend='onnx',
+                    model_kwargs={'file_name': onnx_file} if onnx_file else None
+                )
+                quantize = False
+            else:
+                self.model = SentenceTransformer(model_name, device=self.device)
             self.embedding_dimension = self.model.get_sentence_embedding_dimension()
-            logger.info(f"Initialized embedding model: {model_name} with {self.embedding_dimension} dimensions")
+            
+            if quantize:
+                reference = self.model.encode(QUANTIZATION_CHECK_TEXTS, show_progress_bar=False,
+                                              normalize_embeddings=True)
+                if self.device.startswith('cuda'):
+                    self.model.half()
+                else:
+                    self.model = torch.quantization.quantize_dynamic(
+                        self.model, {torch.nn.Linear}, dtype=torch.qint8
+                    )
+                quantized = self.model.encode(QUANTIZATION_CHECK_TEXTS, show_progress_bar=False,
+                                              normalize_embeddings=True)
+                similarity = float(np.min(np.sum(reference * quantized, axis=1)))
+                if similarity < quantize_min_similarity:
+                    logger.warning(f"{self.precision} embeddings drift from fp32 (cosine similarity {similarity:.4f} "
+                                   f"< {quantize_min_similarity}); consider disabling quantization")
+                else:
+                    logger.info(f"{self.precision} embeddings match fp32 (min cosine similarity {similarity:.4f})")
+            
+            # Pay one-time allocation/kernel selection cost here, not on the first request
+            self.model.encode(["warmup"], batch_size=1, show_progress_bar=False)
+            
+            logger.info(f"Initialized embedding model: {model_name} with {self.embedding_dimension} dimensions "
+                        f"on {self.device} via {backend}{' (quantized)' if quantize else ''}")
         except Exception as e:
             logger.error(f"Failed to initialize embedding model: {str(e)}")
             raise
     
-    def embed_texts(self, texts: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    def embed_texts(self, texts: List[Dict[str, Any]], batch_size: int = 64) -> List[Dict[str, Any]]:
         """
         Embed a list of text documents.
         
         Args:
             texts: List of dictionaries containing 'text' key and metadata
+            batch_size: Number of texts per encode batch within a length bucket
             
         Returns:
-            List of dictionaries with embeddings added
+            List of dictionaries with float32 numpy embeddings added
         """
         try:
             # Extract text strings
@@ -48,20 +167,31 @@ class EmbeddingModel:
                 logger.error("No valid texts to embed")
                 return texts
             
-            # Generate embeddings
-            embeddings = self.model.encode(text_strings, show_progress_bar=False)
+            # Reuse cached embeddings and only encode texts never seen before
+            # Identical texts (e.g. shared across boards) are embedded once and fanned back out
+            unique_texts = list(dict.fromkeys(text_strings))
+            embeddings_by_text = self.cache.get_many(unique_texts) if self.cache else {}
+            missing_texts = [text for text in unique_texts if text not in embeddings_by_text]
+            
+            if missing_texts:
+                new_embeddings = self._encode_bucketed(missing_texts, batch_size=batch_size)
+                fresh = dict(zip(missing_texts, new_embeddings))
+                if self.cache:
+                    self.cache.set_many(fresh)
+                embeddings_by_text.update(fresh)
             
-            # Add embeddings to documents
-            embedding_idx = 0
+            # Add embeddings to documents as float32 rows; they are only
+            # converted to lists at the Pinecone upsert boundary
+            valid_index_set = set(valid_indices)
             for i, doc in enumerate(texts):
-                if i in valid_indices:
-                    doc['embedding'] = embeddings[embedding_idx].tolist()
-                    embedding_idx += 1
+                if i in valid_index_set:
+                    doc['embedding'] = embeddings_by_text[doc['text']]
                 else:
                     # For invalid documents, create a zero embedding
-                    doc['embedding'] = [0.0] * self.embedding_dimension
+                    doc['embedding'] = np.zeros(self.embedding_dimension, dtype=np.float32)
             
-            logger.info(f"Successfully embedded {len(text_strings)} texts")
+            logger.info(f"Successfully embedded {len(text_strings)} texts ({len(unique_texts)} unique, "
+                        f"{len(missing_texts)} encoded, {len(unique_texts) - len(missing_texts)} from cache)")
             return texts
             
         except Exception as e:
@@ -69,6 +199,38 @@ class EmbeddingModel:
             # Return texts without embeddings on error
             return texts
     
+    def _encode_bucketed(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Encode texts grouped into token-length buckets to minimise padding.
+        
+        Args:
+            texts: List of text strings
+            batch_size: Number of texts per encode batch
+            
+        Returns:
+            Array of normalized embeddings in the same order as texts
+        """
+        tokenizer = getattr(self.model, 'tokenizer', None)
+        if tokenizer is not None:
+            lengths = np.array(tokenizer(texts, add_special_tokens=False, return_length=True)['length'])
+        else:
+            lengths = np.array([len(text) for text in texts])
+        
+        bucket_ids = np.searchsorted(LENGTH_BUCKETS, lengths)
+        embeddings = np.empty((len(texts), self.embedding_dimension), dtype=np.float32)
+        
+        for bucket_id in np.unique(bucket_ids):
+            indices = np.flatnonzero(bucket_ids == bucket_id)
+            embeddings[indices] = self.model.encode(
+                [texts[i] for i in indices],
+                batch_size=batch_size,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+        
+        return embeddings
+    
     def embed_query(self, query: str) -> List[float]:
         """
         Embed a single query string.
@@ -84,14 +246,112 @@ class EmbeddingModel:
                 logger.warning("Empty query provided")
                 return [0.0] * self.embedding_dimension
             
-            embedding = self.model.encode(query, show_progress_bar=False)
-            return embedding.tolist()
+            return self.embed_queries([query])[0]
             
         except Exception as e:
             logger.error(f"Error embedding query: {str(e)}")
             # Return zero vector on error
             return [0.0] * self.embedding_dimension
     
+    def embed_queries(self, queries: List[str], batch_size: int = 32) -> List[List[float]]:
+        """
+        Embed several query strings, encoding all uncached ones in one batch.
+        
+        Args:
+            queries: Query texts
+            batch_size: Number of queries per encode batch
+            
+        Returns:
+            List of query embeddings in the same order as queries
+        """
+        try:
+            # The in-memory cache is keyed on the normalized query, so questions
+            # differing only in case, spacing or a trailing '?' skip the model
+            keys = [normalize_query(query) for query in queries]
+            embeddings = {}
+            with self._query_cache_lock:
+                for key in keys:
+                    if key in self._query_cache:
+                        self._query_cache.move_to_end(key)
+                        embeddings[key] = self._query_cache[key]
+                    elif key and self.fuzzy_threshold is not None:
+                        candidates = self._fuzzy_buckets.get(query_numbers(key))
+                        match = candidates and self._fuzzy_extract(key, candidates.keys(), scorer=self._fuzzy_scorer,
+                                                                   score_cutoff=self.fuzzy_threshold)
+                        if match:
+                            self._query_cache.move_to_end(match[0])
+                            # Cached under this spelling too, so a repeat is an exact hit
+                            embeddings[key] = self._query_cache[match[0]]
+                            self._cache_query(key, embeddings[key])
+            
+            # First spelling of each uncached key is the one encoded
+            missing_by_key = {}
+            for key, query in zip(keys, queries):
+                if key and key not in embeddings:
+                    missing_by_key.setdefault(key, query)
+            missing = list(missing_by_key.values())
+            if missing:
+                # Questions asked before a restart come back from the persistent
+                # cache; only never-seen ones reach the model
+                found = self.cache.get_many(missing) if self.cache else {}
+                unseen = [query for query in missing if query not in found]
+                if unseen and self._backfill_executor is not None:
+                    stale = self.cache.get_stale(unseen)
+                    if stale:
+                        found.update(stale)
+                        unseen = [query for query in unseen if query not in stale]
+                        self._backfill_executor.submit(self._backfill_queries, list(stale))
+                if unseen:
+                    encoded = self.model.encode(unseen, batch_size=batch_size, show_progress_bar=False,
+                                                normalize_embeddings=True)
+                    fresh = dict(zip(unseen, encoded.astype(np.float32)))
+                    if self.cache:
+                        self.cache.set_many(fresh)
+                    found.update(fresh)
+                with self._query_cache_lock:
+                    for key, query in missing_by_key.items():
+                        embeddings[key] = found[query].tolist()
+                        self._cache_query(key, embeddings[key])
+            
+            # Hand out copies so callers can't mutate cached vectors
+            zero_vector = [0.0] * self.embedding_dimension
+            return [list(embeddings.get(key, zero_vector)) for key in keys]
+            
+        except Exception as e:
+            logger.error(f"Error embedding queries: {str(e)}")
+            return [[0.0] * self.embedding_dimension for _ in queries]
+    
+    def _cache_query(self, key: str, embedding: List[float]):
+        """Add a query embedding to the in-memory LRU; call with _query_cache_lock held."""
+        self._query_cache[key] = embedding
+        if self.fuzzy_threshold is not None:
+            self._fuzzy_buckets[query_numbers(key)][key] = None
+        while len(self._query_cache) > self.query_cache_size:
+            evicted, _ = self._query_cache.popitem(last=False)
+            if self.fuzzy_threshold is not None:
+                numbers = query_numbers(evicted)
+                bucket = self._fuzzy_buckets[numbers]
+                bucket.pop(evicted, None)
+                if not bucket:
+                    del self._fuzzy_buckets[numbers]
+    
+    def _reset_backfill_executor(self):
+        self._backfill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embed-backfill')
+    
+    def _backfill_queries(self, queries: List[str]):
+        """Re-embed queries served from the previous model's cache with the current model."""
+        try:
+            encoded = self.model.encode(queries, show_progress_bar=False, normalize_embeddings=True)
+            fresh = dict(zip(queries, encoded.astype(np.float32)))
+            self.cache.set_many(fresh)
+            with self._query_cache_lock:
+                for query, embedding in fresh.items():
+                    key = normalize_query(query)
+                    if key in self._query_cache:
+                        self._query_cache[key] = embedding.tolist()
+        except Exception as e:
+            logger.error(f"Error re-embedding migrated queries: {str(e)}")
+    
     def embed_batch(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
         """
         Embed multiple texts in batches (useful for large datasets).
@@ -111,8 +371,8 @@ class EmbeddingModel:
             
             for i in range(0, len(texts), batch_size):
                 batch = texts[i:i + batch_size]
-                batch_embeddings = self.model.encode(batch, show_progress_bar=False)
-                all_embeddings.extend(batch_embeddings.tolist())
+                batch_embeddings = self.model.encode(batch, show_progress_bar=False, normalize_embeddings=True)
+                all_embeddings.extend(batch_embeddings.astype(np.float32).tolist())
             
             logger.info(f"Embedded {len(texts)} texts in batches of {batch_size}")
             return all_embeddings
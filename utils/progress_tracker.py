@@ -1,153 +1,471 @@
+import os
 import sqlite3
-import json
-from datetime import datetime, timedelta
+import orjson
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import Counter, defaultdict
 from typing import Dict, List, Any, Optional
 import logging
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 
 logger = logging.getLogger(__name__)
 
+# Applied to every connection: WAL lets readers run alongside the writer and,
+# with synchronous=NORMAL, commits no longer fsync the database file
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',  # 64 MB page cache
+    'PRAGMA mmap_size=268435456',  # 256 MB memory-mapped reads
+    'PRAGMA busy_timeout=5000',
+)
+
+# Write-path statements are module constants so every call passes the same
+# SQL text and hits the writer connection's prepared-statement cache
+_SQL_INSERT_INTERACTION = '''
+    INSERT INTO interactions
+    (student_id, content_id, topic, subtopic, success, time_taken,
+     error_type, difficulty_level, method_tags, question_text, user_answer)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Upserts update the existing row in place; mastery_level is a generated
+# column, so it follows the counters without a write of its own. Counters
+# are added as deltas so one statement can apply a whole batch's worth
+_SQL_UPSERT_TOPIC_MASTERY = '''
+    INSERT INTO topic_mastery
+    (student_id, topic, total_attempts, correct_attempts, total_time, last_attempt)
+    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(student_id, topic) DO UPDATE SET
+        total_attempts = total_attempts + excluded.total_attempts,
+        correct_attempts = correct_attempts + excluded.correct_attempts,
+        total_time = total_time + excluded.total_time,
+        last_attempt = CURRENT_TIMESTAMP
+'''
+
+_SQL_UPSERT_SUBTOPIC_MASTERY = '''
+    INSERT INTO subtopic_mastery
+    (student_id, topic, subtopic, attempts, correct, last_attempt)
+    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(student_id, topic, subtopic) DO UPDATE SET
+        attempts = attempts + excluded.attempts,
+        correct = correct + excluded.correct,
+        last_attempt = CURRENT_TIMESTAMP
+'''
+
+_SQL_UPSERT_ERROR_PATTERN = '''
+    INSERT INTO error_patterns
+    (student_id, topic, error_type, frequency, last_occurrence)
+    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(student_id, topic, error_type) DO UPDATE SET
+        frequency = frequency + excluded.frequency,
+        last_occurrence = CURRENT_TIMESTAMP
+'''
+
+def _fetch_dicts(cursor: sqlite3.Cursor) -> List[Dict[str, Any]]:
+    """Fetch all rows as dicts; zipping plain tuples is cheaper than dict(sqlite3.Row)"""
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
 class SQLiteProgressTracker:
-    def __init__(self, db_path: str = "student_progress.db"):
+    def __init__(self, db_path: str = "student_progress.db", flush_interval: float = 0.2,
+                 in_memory: bool = False, snapshot_interval: float = 30.0):
+        """
+        Args:
+            db_path: SQLite database file
+            flush_interval: Seconds the write-behind thread collects queued interactions per batch
+            in_memory: Keep the database in memory, restored from db_path at startup and
+                       snapshotted back to it every snapshot_interval seconds and at exit.
+                       Writes never touch disk, at the cost of losing up to one interval of
+                       progress on a crash. Only for a single process: forked workers would
+                       each snapshot their own copy over the same file
+            snapshot_interval: Seconds between snapshots in in_memory mode
+        """
         self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.in_memory = in_memory
+        self.snapshot_interval = snapshot_interval
+        # Read connections are reused per thread, keeping their page and
+        # statement caches warm across calls
+        self._local = threading.local()
+        
+        # One long-lived writer connection, serialized by a lock; autocommit
+        # mode so each write method controls its own BEGIN/COMMIT. In memory
+        # mode it is the only connection and reads share it under the lock
+        # (re-entrant, as some reads nest)
+        self._write_lock = threading.RLock()
+        self._write_conn = self._connect_writer()
+        if in_memory and os.path.exists(db_path):
+            disk_conn = sqlite3.connect(db_path)
+            disk_conn.backup(self._write_conn)
+            disk_conn.close()
         self.init_database()
+        
+        self._start_background_threads()
+        if in_memory:
+            # atexit runs handlers last-in first-out: flush, then snapshot
+            atexit.register(self.snapshot)
+        atexit.register(self.flush)
+        # SQLite connections and threads do not survive fork; a forked worker
+        # opens its own connections and starts its own writer threads. The
+        # write lock is held across the fork so no transaction is mid-flight
+        # on the connection the child copies
+        os.register_at_fork(before=self._write_lock.acquire,
+                            after_in_parent=self._write_lock.release,
+                            after_in_child=self._reset_connections)
+    
+    def _start_background_threads(self):
+        # Write-behind queue: interactions are batched into one transaction
+        self._write_queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_behind_loop, name='progress-writer', daemon=True)
+        self._writer.start()
+        if self.in_memory:
+            self._snapshotter = threading.Thread(target=self._snapshot_loop, name='progress-snapshot', daemon=True)
+            self._snapshotter.start()
+    
+    def _connect_writer(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(':memory:' if self.in_memory else self.db_path, isolation_level=None,
+                               check_same_thread=False, cached_statements=256)
+        self._configure_connection(conn)
+        return conn
     
     @contextmanager
     def get_db_connection(self):
-        """Context manager for database connections"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row  
+        """Context manager for this thread's database connection"""
+        if self.in_memory:
+            lock, conn = self._write_lock, self._write_conn
+        else:
+            lock, conn = nullcontext(), getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = sqlite3.connect(self.db_path)
+                self._configure_connection(conn)
+                self._local.conn = conn
+        with lock:
+            try:
+                yield conn
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"Database error: {e}")
+                raise
+    
+    def snapshot(self) -> bool:
+        """Copy the in-memory database to db_path with SQLite's online backup API"""
+        if not self.in_memory:
+            return False
         try:
-            yield conn
-        except Exception as e:
-            conn.rollback()
-            logger.error(f"Database error: {e}")
-            raise
-        finally:
+            with self._write_lock:
+                disk_conn = sqlite3.connect(self.db_path)
+                try:
+                    self._write_conn.backup(disk_conn)
+                finally:
+                    disk_conn.close()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Error snapshotting progress database: {e}")
+            return False
+    
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self.snapshot()
+    
+    def close(self):
+        """Flush queued writes and close the writer and this thread's connection (call at worker shutdown)"""
+        self.flush()
+        self.snapshot()
+        atexit.unregister(self.flush)
+        atexit.unregister(self.snapshot)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
             conn.close()
+            self._local.conn = None
+        with self._write_lock:
+            self._write_conn.close()
+    
+    def _reset_connections(self):
+        self._local = threading.local()
+        if self.in_memory:
+            # Carry the parent's in-memory data over into the child's own
+            # connection; the parent's is idle, as the fork held the write lock
+            conn = self._connect_writer()
+            self._write_conn.backup(conn)
+            self._write_conn = conn
+        else:
+            self._write_conn = self._connect_writer()
+        self._write_lock = threading.RLock()
+        # The parent's queue is shared with no thread here (and may hold
+        # unfinished tasks that flush would wait on forever)
+        self._start_background_threads()
+    
+    @staticmethod
+    def _configure_connection(conn: sqlite3.Connection):
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+    
+    @contextmanager
+    def write_transaction(self):
+        """Run a write method's statements on the shared writer connection as one transaction"""
+        with self._write_lock:
+            conn = self._write_conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception as e:
+                conn.execute('ROLLBACK')
+                logger.error(f"Database error: {e}")
+                raise
+    
+    @staticmethod
+    def _has_stored_mastery_level(cursor, table: str) -> bool:
+        """True if table has mastery_level as an ordinary (not generated) column"""
+        # table_xinfo reports generated columns with hidden = 2 (virtual) or 3 (stored)
+        return any(
+            row['name'] == 'mastery_level' and row['hidden'] == 0
+            for row in cursor.execute(f'PRAGMA table_xinfo({table})')
+        )
     
     def init_database(self):
         """Initialize SQLite database with all required tables"""
-        with self.get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Students table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS students (
-                    student_id TEXT PRIMARY KEY,
-                    grade INTEGER,
-                    board TEXT,
-                    language TEXT DEFAULT 'english',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    total_questions INTEGER DEFAULT 0,
-                    total_correct INTEGER DEFAULT 0,
-                    total_time_minutes INTEGER DEFAULT 0
-                )
-            ''')
-            
-            # Student interactions table (detailed log of every interaction)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS interactions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT,
-                    content_id TEXT,
-                    topic TEXT,
-                    subtopic TEXT,
-                    success BOOLEAN,
-                    time_taken INTEGER DEFAULT 0,
-                    error_type TEXT,
-                    difficulty_level INTEGER,
-                    method_tags TEXT,  -- JSON array of method tags
-                    question_text TEXT,
-                    user_answer TEXT,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (student_id) REFERENCES students (student_id)
-                )
-            ''')
-            
-            # Topic mastery table (aggregated data per topic)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS topic_mastery (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT,
-                    topic TEXT,
-                    total_attempts INTEGER DEFAULT 0,
-                    correct_attempts INTEGER DEFAULT 0,
-                    total_time INTEGER DEFAULT 0,
-                    mastery_level REAL DEFAULT 0.0,
-                    last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (student_id) REFERENCES students (student_id),
-                    UNIQUE(student_id, topic)
-                )
-            ''')
-            
-            # Subtopic mastery table (detailed progress per subtopic)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS subtopic_mastery (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT,
-                    topic TEXT,
-                    subtopic TEXT,
-                    attempts INTEGER DEFAULT 0,
-                    correct INTEGER DEFAULT 0,
-                    mastery_level REAL DEFAULT 0.0,
-                    last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (student_id) REFERENCES students (student_id),
-                    UNIQUE(student_id, topic, subtopic)
-                )
-            ''')
-            
-            # Learning sessions table (track study sessions)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS learning_sessions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT,
-                    session_start TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    session_end TIMESTAMP,
-                    topics_covered TEXT,  -- JSON array of topics
-                    questions_attempted INTEGER DEFAULT 0,
-                    questions_correct INTEGER DEFAULT 0,
-                    total_time_minutes INTEGER DEFAULT 0,
-                    FOREIGN KEY (student_id) REFERENCES students (student_id)
+        # One transaction on the writer connection, so a crash part way
+        # leaves the database as it was
+        with self.write_transaction() as conn:
+            self._create_schema(conn.cursor())
+        logger.info("Database initialized successfully")
+    
+    def _create_schema(self, cursor):
+        """Create or upgrade every table, trigger and index on an open transaction"""
+        # Databases created before mastery_level became a generated column
+        # are rebuilt: the old tables are moved aside here and copied over
+        # once the new ones exist. A *_legacy table left behind by an
+        # interrupted rebuild from older versions is copied over as well
+        existing = {
+            row['name'] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+        legacy_tables = []
+        for table in ('topic_mastery', 'subtopic_mastery'):
+            if f'{table}_legacy' in existing:
+                legacy_tables.append(table)
+            elif table in existing and self._has_stored_mastery_level(cursor, table):
+                cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+                legacy_tables.append(table)
+        
+        # Students table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS students (
+                student_id TEXT PRIMARY KEY,
+                grade INTEGER,
+                board TEXT,
+                language TEXT DEFAULT 'english',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                total_questions INTEGER DEFAULT 0,
+                total_correct INTEGER DEFAULT 0,
+                total_time_minutes INTEGER DEFAULT 0
+            )
+        ''')
+        
+        # Student interactions table (detailed log of every interaction)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS interactions (
+                id INTEGER PRIMARY KEY,  -- plain rowid alias; ids are never looked up
+                student_id TEXT,
+                content_id TEXT,
+                topic TEXT,
+                subtopic TEXT,
+                success BOOLEAN,
+                time_taken INTEGER DEFAULT 0,
+                error_type TEXT,
+                difficulty_level INTEGER,
+                method_tags TEXT,  -- JSON array of method tags, NULL when there are none
+                question_text TEXT,
+                user_answer TEXT,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (student_id) REFERENCES students (student_id)
+            )
+        ''')
+        
+        # Topic mastery table (aggregated data per topic)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS topic_mastery (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id TEXT,
+                topic TEXT,
+                total_attempts INTEGER DEFAULT 0,
+                correct_attempts INTEGER DEFAULT 0,
+                total_time INTEGER DEFAULT 0,
+                mastery_level REAL GENERATED ALWAYS AS
+                    (CAST(correct_attempts AS REAL) / MAX(total_attempts, 1)) VIRTUAL,
+                last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (student_id) REFERENCES students (student_id),
+                UNIQUE(student_id, topic)
+            )
+        ''')
+        
+        # Subtopic mastery table (detailed progress per subtopic)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS subtopic_mastery (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id TEXT,
+                topic TEXT,
+                subtopic TEXT,
+                attempts INTEGER DEFAULT 0,
+                correct INTEGER DEFAULT 0,
+                mastery_level REAL GENERATED ALWAYS AS
+                    (CAST(correct AS REAL) / MAX(attempts, 1)) VIRTUAL,
+                last_attempt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (student_id) REFERENCES students (student_id),
+                UNIQUE(student_id, topic, subtopic)
+            )
+        ''')
+        
+        # Learning sessions table (track study sessions)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS learning_sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id TEXT,
+                session_start TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                session_end TIMESTAMP,
+                topics_covered TEXT,  -- JSON array of topics
+                questions_attempted INTEGER DEFAULT 0,
+                questions_correct INTEGER DEFAULT 0,
+                total_time_minutes INTEGER DEFAULT 0,
+                FOREIGN KEY (student_id) REFERENCES students (student_id)
+            )
+        ''')
+        
+        # Error patterns table (track common mistakes)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS error_patterns (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                student_id TEXT,
+                topic TEXT,
+                error_type TEXT,
+                frequency INTEGER DEFAULT 1,
+                last_occurrence TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (student_id) REFERENCES students (student_id),
+                UNIQUE(student_id, topic, error_type)
+            )
+        ''')
+        
+        # Per-student daily rollup for get_performance_analytics, kept
+        # current by a trigger so analytics never scan interactions.
+        # difficulty_level is part of the key, so NULL is stored as -1
+        rollup_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'student_daily_stats'"
+        ).fetchone() is not None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS student_daily_stats (
+                student_id TEXT NOT NULL,
+                day DATE NOT NULL,
+                difficulty_level INTEGER NOT NULL,
+                hour INTEGER NOT NULL,
+                questions INTEGER DEFAULT 0,
+                correct INTEGER DEFAULT 0,
+                total_time INTEGER DEFAULT 0,
+                PRIMARY KEY (student_id, day, difficulty_level, hour)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_interactions_rollup AFTER INSERT ON interactions
+            BEGIN
+                INSERT INTO student_daily_stats
+                (student_id, day, difficulty_level, hour, questions, correct, total_time)
+                VALUES (
+                    NEW.student_id, DATE(NEW.timestamp), IFNULL(NEW.difficulty_level, -1),
+                    CAST(strftime('%H', NEW.timestamp) AS INTEGER), 1,
+                    CASE WHEN NEW.success THEN 1 ELSE 0 END, IFNULL(NEW.time_taken, 0)
                 )
-            ''')
-            
-            # Error patterns table (track common mistakes)
+                ON CONFLICT(student_id, day, difficulty_level, hour) DO UPDATE SET
+                    questions = questions + 1,
+                    correct = correct + excluded.correct,
+                    total_time = total_time + excluded.total_time;
+            END
+        ''')
+        # Student running totals, updated inside the interaction insert
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_student_totals AFTER INSERT ON interactions
+            BEGIN
+                UPDATE students
+                SET total_questions = total_questions + 1,
+                    total_correct = total_correct + (CASE WHEN NEW.success THEN 1 ELSE 0 END),
+                    total_time_minutes = total_time_minutes + IFNULL(NEW.time_taken, 0),
+                    last_active = CURRENT_TIMESTAMP
+                WHERE student_id = NEW.student_id;
+            END
+        ''')
+        if not rollup_exists:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS error_patterns (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    student_id TEXT,
-                    topic TEXT,
-                    error_type TEXT,
-                    frequency INTEGER DEFAULT 1,
-                    last_occurrence TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (student_id) REFERENCES students (student_id),
-                    UNIQUE(student_id, topic, error_type)
-                )
+                INSERT INTO student_daily_stats
+                (student_id, day, difficulty_level, hour, questions, correct, total_time)
+                SELECT student_id, DATE(timestamp), IFNULL(difficulty_level, -1),
+                       CAST(strftime('%H', timestamp) AS INTEGER), COUNT(*),
+                       SUM(CASE WHEN success THEN 1 ELSE 0 END), SUM(IFNULL(time_taken, 0))
+                FROM interactions
+                GROUP BY 1, 2, 3, 4
             ''')
-            
-            # Create indexes for better performance
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_interactions_student_topic ON interactions(student_id, topic)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_interactions_timestamp ON interactions(timestamp)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_topic_mastery_student ON topic_mastery(student_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_subtopic_mastery_student ON subtopic_mastery(student_id, topic)')
-            
-            conn.commit()
-            logger.info("Database initialized successfully")
-    
+        
+        for table in legacy_tables:
+            columns = ', '.join(
+                row['name'] for row in cursor.execute(f'PRAGMA table_info({table}_legacy)')
+                if row['name'] != 'mastery_level'
+            )
+            cursor.execute(f'INSERT OR IGNORE INTO {table} ({columns}) SELECT {columns} FROM {table}_legacy')
+            cursor.execute(f'DROP TABLE {table}_legacy')
+        
+        # Create indexes for better performance
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_interactions_student_topic ON interactions(student_id, topic)')
+        # Recent activity and session stats: rows come out newest first
+        # straight from the index, with no sort and no table lookups
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_interactions_student_ts ON interactions
+            (student_id, timestamp DESC, topic, subtopic, success, time_taken, difficulty_level)
+        ''')
+        
+        # Covering indexes for the progress summary: each per-student read
+        # is answered from index pages in the order it asks for
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_topic_mastery_cover ON topic_mastery
+            (student_id, last_attempt DESC, topic, total_attempts, correct_attempts, mastery_level, total_time)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_subtopic_cover ON subtopic_mastery
+            (student_id, topic, mastery_level, subtopic, attempts, correct)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_error_patterns_student_topic ON error_patterns
+            (student_id, topic, frequency DESC, error_type)
+        ''')
+        # Prefixes of the covering indexes above, and a timestamp-only index
+        # no query uses (every interactions read filters on student_id);
+        # these only cost writes now
+        cursor.execute('DROP INDEX IF EXISTS idx_interactions_timestamp')
+        cursor.execute('DROP INDEX IF EXISTS idx_topic_mastery_student')
+        cursor.execute('DROP INDEX IF EXISTS idx_subtopic_mastery_student')
+
     def create_or_update_student(self, student_id: str, grade: int, board: str, language: str = 'english') -> bool:
         """Create new student or update existing student profile"""
-        with self.get_db_connection() as conn:
+        with self.write_transaction() as conn:
             cursor = conn.cursor()
             
+            # Update in place: REPLACE would delete the row, resetting
+            # created_at and the running totals
             cursor.execute('''
-                INSERT OR REPLACE INTO students 
+                INSERT INTO students 
                 (student_id, grade, board, language, last_active)
                 VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(student_id) DO UPDATE SET
+                    grade = excluded.grade,
+                    board = excluded.board,
+                    language = excluded.language,
+                    last_active = CURRENT_TIMESTAMP
             ''', (student_id, grade, board, language))
             
-            conn.commit()
             return True
     
     def record_interaction(self, student_id: str, content_id: str, topic: str, 
@@ -156,88 +474,165 @@ class SQLiteProgressTracker:
                          method_tags: List[str] = None, question_text: str = None,
                          user_answer: str = None) -> bool:
         """Record a detailed interaction"""
-        with self.get_db_connection() as conn:
+        # All inserts and aggregate updates share one transaction (one fsync)
+        with self.write_transaction() as conn:
             cursor = conn.cursor()
-            
-            # Insert interaction record
-            cursor.execute('''
-                INSERT INTO interactions 
-                (student_id, content_id, topic, subtopic, success, time_taken, 
-                 error_type, difficulty_level, method_tags, question_text, user_answer)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (student_id, content_id, topic, subtopic, success, time_taken,
-                  error_type, difficulty_level, json.dumps(method_tags or []),
-                  question_text, user_answer))
-            
-            # Update student totals
-            cursor.execute('''
-                UPDATE students 
-                SET total_questions = total_questions + 1,
-                    total_correct = total_correct + ?,
-                    total_time_minutes = total_time_minutes + ?,
-                    last_active = CURRENT_TIMESTAMP
-                WHERE student_id = ?
-            ''', (1 if success else 0, time_taken, student_id))
-            
-            # Update topic mastery
-            cursor.execute('''
-                INSERT OR REPLACE INTO topic_mastery 
-                (student_id, topic, total_attempts, correct_attempts, total_time, last_attempt)
-                VALUES (
-                    ?, ?, 
-                    COALESCE((SELECT total_attempts FROM topic_mastery WHERE student_id = ? AND topic = ?), 0) + 1,
-                    COALESCE((SELECT correct_attempts FROM topic_mastery WHERE student_id = ? AND topic = ?), 0) + ?,
-                    COALESCE((SELECT total_time FROM topic_mastery WHERE student_id = ? AND topic = ?), 0) + ?,
-                    CURRENT_TIMESTAMP
-                )
-            ''', (student_id, topic, student_id, topic, student_id, topic, 
-                  1 if success else 0, student_id, topic, time_taken))
-            
-            # Calculate and update mastery level
-            cursor.execute('''
-                UPDATE topic_mastery 
-                SET mastery_level = CAST(correct_attempts AS REAL) / total_attempts
-                WHERE student_id = ? AND topic = ?
-            ''', (student_id, topic))
-            
-            # Update subtopic mastery if provided
+            self._write_interaction(cursor, student_id, content_id, topic, success, subtopic, time_taken,
+                                    error_type, difficulty_level, method_tags, question_text, user_answer)
+            return True
+    
+    def record_interactions_bulk(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        Record many interactions in one transaction.
+        
+        Each row is a dict with record_interaction's arguments as keys. The
+        mastery and error tables get one upsert per distinct topic, subtopic
+        and error pattern in the batch rather than one per row.
+        
+        Returns:
+            Number of interactions recorded
+        """
+        records = [
+            (row['student_id'], row['content_id'], row['topic'], row['success'], row.get('subtopic'),
+             row.get('time_taken') or 0, row.get('error_type'), row.get('difficulty_level'),
+             row.get('method_tags'), row.get('question_text'), row.get('user_answer'))
+            for row in rows
+        ]
+        if not records:
+            return 0
+        
+        with self.write_transaction() as conn:
+            self._write_interactions(conn.cursor(), records)
+        
+        return len(records)
+    
+    def enqueue_interaction(self, student_id: str, content_id: str, topic: str,
+                            success: bool, subtopic: str = None, time_taken: int = 0,
+                            error_type: str = None, difficulty_level: int = None,
+                            method_tags: List[str] = None, question_text: str = None,
+                            user_answer: str = None) -> bool:
+        """Queue an interaction for the write-behind thread and return immediately"""
+        self._write_queue.put((student_id, content_id, topic, success, subtopic, time_taken or 0,
+                               error_type, difficulty_level, method_tags, question_text, user_answer))
+        return True
+    
+    def flush(self):
+        """Block until every queued interaction has been written"""
+        self._write_queue.join()
+    
+    def _write_behind_loop(self):
+        """Drain the queue every flush_interval and commit each batch in one transaction"""
+        while True:
+            records = [self._write_queue.get()]
+            time.sleep(self.flush_interval)
+            while True:
+                try:
+                    records.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            try:
+                with self.write_transaction() as conn:
+                    cursor = conn.cursor()
+                    # Write the batch with one executemany per statement; if
+                    # any record fails (e.g. unserializable method tags),
+                    # redo it record by record so the rest of the batch is kept
+                    cursor.execute('SAVEPOINT batch')
+                    try:
+                        self._write_interactions(cursor, records)
+                    except Exception:
+                        cursor.execute('ROLLBACK TO batch')
+                        self._write_each_interaction(cursor, records)
+                    cursor.execute('RELEASE batch')
+            except Exception as e:
+                logger.error(f"Error writing {len(records)} queued interactions: {e}")
+            finally:
+                for _ in records:
+                    self._write_queue.task_done()
+    
+    def _write_each_interaction(self, cursor, records: List[tuple]):
+        """Apply interactions one at a time, logging and skipping any that fail"""
+        for record in records:
+            cursor.execute('SAVEPOINT interaction')
+            try:
+                self._write_interaction(cursor, *record)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO interaction')
+                logger.error(f"Dropped queued interaction for {record[0]}: {e}")
+            cursor.execute('RELEASE interaction')
+    
+    def _write_interactions(self, cursor, records: List[tuple]):
+        """
+        Apply a batch of interactions (tuples in _write_interaction's argument
+        order) with one executemany per statement, pre-aggregating the deltas
+        so each distinct topic, subtopic and error pattern is upserted once.
+        Student totals follow the interaction inserts via trg_student_totals.
+        """
+        interactions = []
+        topic_deltas = defaultdict(lambda: [0, 0, 0])
+        subtopic_deltas = defaultdict(lambda: [0, 0])
+        error_counts = Counter()
+        
+        for (student_id, content_id, topic, success, subtopic, time_taken, error_type,
+             difficulty_level, method_tags, question_text, user_answer) in records:
+            correct = 1 if success else 0
+            
+            interactions.append((
+                student_id, content_id, topic, subtopic, success, time_taken,
+                error_type, difficulty_level, orjson.dumps(method_tags).decode() if method_tags else None,
+                question_text, user_answer
+            ))
+            deltas = topic_deltas[(student_id, topic)]
+            deltas[0] += 1
+            deltas[1] += correct
+            deltas[2] += time_taken
             if subtopic:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO subtopic_mastery 
-                    (student_id, topic, subtopic, attempts, correct, last_attempt)
-                    VALUES (
-                        ?, ?, ?,
-                        COALESCE((SELECT attempts FROM subtopic_mastery WHERE student_id = ? AND topic = ? AND subtopic = ?), 0) + 1,
-                        COALESCE((SELECT correct FROM subtopic_mastery WHERE student_id = ? AND topic = ? AND subtopic = ?), 0) + ?,
-                        CURRENT_TIMESTAMP
-                    )
-                ''', (student_id, topic, subtopic, student_id, topic, subtopic,
-                      student_id, topic, subtopic, 1 if success else 0))
-                
-                # Calculate subtopic mastery level
-                cursor.execute('''
-                    UPDATE subtopic_mastery 
-                    SET mastery_level = CAST(correct AS REAL) / attempts
-                    WHERE student_id = ? AND topic = ? AND subtopic = ?
-                ''', (student_id, topic, subtopic))
-            
-            # Track error patterns
+                deltas = subtopic_deltas[(student_id, topic, subtopic)]
+                deltas[0] += 1
+                deltas[1] += correct
             if error_type and not success:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO error_patterns 
-                    (student_id, topic, error_type, frequency, last_occurrence)
-                    VALUES (
-                        ?, ?, ?,
-                        COALESCE((SELECT frequency FROM error_patterns WHERE student_id = ? AND topic = ? AND error_type = ?), 0) + 1,
-                        CURRENT_TIMESTAMP
-                    )
-                ''', (student_id, topic, error_type, student_id, topic, error_type))
-            
-            conn.commit()
-            return True
+                error_counts[(student_id, topic, error_type)] += 1
+        
+        cursor.executemany(_SQL_INSERT_INTERACTION, interactions)
+        cursor.executemany(_SQL_UPSERT_TOPIC_MASTERY, [
+            (*key, attempts, correct, time_taken)
+            for key, (attempts, correct, time_taken) in topic_deltas.items()
+        ])
+        cursor.executemany(_SQL_UPSERT_SUBTOPIC_MASTERY, [
+            (*key, attempts, correct) for key, (attempts, correct) in subtopic_deltas.items()
+        ])
+        cursor.executemany(_SQL_UPSERT_ERROR_PATTERN, [
+            (*key, frequency) for key, frequency in error_counts.items()
+        ])
+    
+    def _write_interaction(self, cursor, student_id: str, content_id: str, topic: str,
+                           success: bool, subtopic: str, time_taken: int, error_type: str,
+                           difficulty_level: int, method_tags: List[str], question_text: str,
+                           user_answer: str):
+        """Apply one interaction and its aggregate updates on an open cursor"""
+        # Insert interaction record; student totals follow via trg_student_totals
+        cursor.execute(_SQL_INSERT_INTERACTION, (
+            student_id, content_id, topic, subtopic, success, time_taken,
+            error_type, difficulty_level, orjson.dumps(method_tags).decode() if method_tags else None,
+            question_text, user_answer
+        ))
+        
+        # Update topic mastery
+        correct = 1 if success else 0
+        cursor.execute(_SQL_UPSERT_TOPIC_MASTERY, (student_id, topic, 1, correct, time_taken))
+        
+        # Update subtopic mastery if provided
+        if subtopic:
+            cursor.execute(_SQL_UPSERT_SUBTOPIC_MASTERY, (student_id, topic, subtopic, 1, correct))
+        
+        # Track error patterns
+        if error_type and not success:
+            cursor.execute(_SQL_UPSERT_ERROR_PATTERN, (student_id, topic, error_type, 1))
     
     def get_student_mastery(self, student_id: str, topic: str) -> float:
         """Get student's mastery level for a specific topic"""
+        # Reads reflect interactions the caller has queued so far
+        self.flush()
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
             
@@ -251,6 +646,7 @@ class SQLiteProgressTracker:
     
     def get_student_progress_summary(self, student_id: str) -> Dict[str, Any]:
         """Get comprehensive progress summary for a student"""
+        self.flush()
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
             
@@ -271,28 +667,38 @@ class SQLiteProgressTracker:
             ''', (student_id,))
             topics = cursor.fetchall()
             
-            # Get subtopic details for each topic
+            # Get subtopic details and common errors for all topics at once,
+            # already sorted so each topic's weakest subtopic and top errors come first
+            cursor.execute('''
+                SELECT topic, subtopic, attempts, correct, mastery_level
+                FROM subtopic_mastery 
+                WHERE student_id = ?
+                ORDER BY topic, mastery_level ASC
+            ''', (student_id,))
+            
+            subtopics_by_topic = defaultdict(list)
+            for row in cursor.fetchall():
+                subtopics_by_topic[row['topic']].append({
+                    'subtopic': row['subtopic'],
+                    'attempts': row['attempts'],
+                    'correct': row['correct'],
+                    'mastery_level': row['mastery_level']
+                })
+            
+            cursor.execute('''
+                SELECT topic, error_type, frequency
+                FROM error_patterns 
+                WHERE student_id = ?
+                ORDER BY topic, frequency DESC
+            ''', (student_id,))
+            
+            errors_by_topic = defaultdict(list)
+            for row in cursor.fetchall():
+                errors_by_topic[row['topic']].append({'error_type': row['error_type'], 'frequency': row['frequency']})
+            
             topic_details = {}
             for topic in topics:
-                cursor.execute('''
-                    SELECT subtopic, attempts, correct, mastery_level
-                    FROM subtopic_mastery 
-                    WHERE student_id = ? AND topic = ?
-                    ORDER BY mastery_level ASC
-                ''', (student_id, topic['topic']))
-                
-                subtopics = cursor.fetchall()
-                
-                # Get common errors for this topic
-                cursor.execute('''
-                    SELECT error_type, frequency
-                    FROM error_patterns 
-                    WHERE student_id = ? AND topic = ?
-                    ORDER BY frequency DESC
-                    LIMIT 5
-                ''', (student_id, topic['topic']))
-                
-                errors = cursor.fetchall()
+                subtopics = subtopics_by_topic.get(topic['topic'], [])
                 
                 topic_details[topic['topic']] = {
                     'mastery_level': topic['mastery_level'],
@@ -301,12 +707,14 @@ class SQLiteProgressTracker:
                     'accuracy': f"{(topic['correct_attempts'] / max(1, topic['total_attempts']) * 100):.1f}%",
                     'time_spent_minutes': topic['total_time'],
                     'last_attempt': topic['last_attempt'],
-                    'subtopics': [dict(sub) for sub in subtopics],
-                    'common_errors': [dict(err) for err in errors],
-                    'weakest_subtopic': min(subtopics, key=lambda x: x['mastery_level'], default=None)
+                    'subtopics': subtopics,
+                    'common_errors': errors_by_topic.get(topic['topic'], [])[:5],
+                    'weakest_subtopic': subtopics[0] if subtopics else None
                 }
             
             # Get recent activity (last 10 interactions)
+            cursor = conn.cursor()
+            cursor.row_factory = None
             cursor.execute('''
                 SELECT topic, subtopic, success, time_taken, timestamp, difficulty_level
                 FROM interactions 
@@ -315,7 +723,7 @@ class SQLiteProgressTracker:
                 LIMIT 10
             ''', (student_id,))
             
-            recent_activity = [dict(row) for row in cursor.fetchall()]
+            recent_activity = _fetch_dicts(cursor)
             
             # Calculate overall statistics
             overall_accuracy = (student['total_correct'] / max(1, student['total_questions'])) * 100
@@ -344,7 +752,9 @@ class SQLiteProgressTracker:
     def get_learning_recommendations(self, student_id: str) -> Dict[str, Any]:
         """Generate personalized learning recommendations"""
         with self.get_db_connection() as conn:
+            # Every result here is returned as plain dicts
             cursor = conn.cursor()
+            cursor.row_factory = None
             
             # Get topics with low mastery (need remediation)
             cursor.execute('''
@@ -354,7 +764,7 @@ class SQLiteProgressTracker:
                 ORDER BY mastery_level ASC
             ''', (student_id,))
             
-            weak_topics = [dict(row) for row in cursor.fetchall()]
+            weak_topics = _fetch_dicts(cursor)
             
             # Get topics with good mastery (ready for advancement)
             cursor.execute('''
@@ -364,7 +774,7 @@ class SQLiteProgressTracker:
                 ORDER BY mastery_level DESC
             ''', (student_id,))
             
-            strong_topics = [dict(row) for row in cursor.fetchall()]
+            strong_topics = _fetch_dicts(cursor)
             
             # Get most common error patterns across all topics
             cursor.execute('''
@@ -376,7 +786,7 @@ class SQLiteProgressTracker:
                 LIMIT 3
             ''', (student_id,))
             
-            common_errors = [dict(row) for row in cursor.fetchall()]
+            common_errors = _fetch_dicts(cursor)
             
             recommendations = {
                 'priority_actions': [],
@@ -411,50 +821,50 @@ class SQLiteProgressTracker:
     
     def get_performance_analytics(self, student_id: str, days: int = 30) -> Dict[str, Any]:
         """Get detailed performance analytics for the last N days"""
+        self.flush()
         with self.get_db_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = None
             
-            cutoff_date = datetime.now() - timedelta(days=days)
-            
-            # Daily performance trend
-            cursor.execute('''
-                SELECT DATE(timestamp) as date,
-                       COUNT(*) as questions,
-                       SUM(CASE WHEN success THEN 1 ELSE 0 END) as correct,
-                       AVG(time_taken) as avg_time
-                FROM interactions 
-                WHERE student_id = ? AND timestamp >= ?
-                GROUP BY DATE(timestamp)
-                ORDER BY date
-            ''', (student_id, cutoff_date))
-            
-            daily_performance = [dict(row) for row in cursor.fetchall()]
-            
-            # Performance by difficulty level
-            cursor.execute('''
-                SELECT difficulty_level,
-                       COUNT(*) as attempts,
-                       AVG(CASE WHEN success THEN 1.0 ELSE 0.0 END) as success_rate
-                FROM interactions 
-                WHERE student_id = ? AND timestamp >= ? AND difficulty_level IS NOT NULL
-                GROUP BY difficulty_level
-                ORDER BY difficulty_level
-            ''', (student_id, cutoff_date))
-            
-            difficulty_performance = [dict(row) for row in cursor.fetchall()]
+            # The rollup is kept per day, so the window starts at the cutoff's date
+            cutoff_day = (datetime.now(timezone.utc) - timedelta(days=days)).date().isoformat()
             
-            # Time of day performance
+            # All three breakdowns in one round trip: the student's window of
+            # the rollup is read once and each grouping is tagged with its kind
             cursor.execute('''
-                SELECT CAST(strftime('%H', timestamp) AS INTEGER) as hour,
-                       COUNT(*) as questions,
-                       AVG(CASE WHEN success THEN 1.0 ELSE 0.0 END) as accuracy
-                FROM interactions 
-                WHERE student_id = ? AND timestamp >= ?
-                GROUP BY hour
-                ORDER BY hour
-            ''', (student_id, cutoff_date))
-            
-            hourly_performance = [dict(row) for row in cursor.fetchall()]
+                WITH window_stats AS MATERIALIZED (
+                    SELECT day, difficulty_level, hour, questions, correct, total_time
+                    FROM student_daily_stats
+                    WHERE student_id = ? AND day >= ?
+                )
+                SELECT 'daily' as kind, day as key, SUM(questions) as questions, SUM(correct) as correct,
+                       CAST(SUM(total_time) AS REAL) / SUM(questions) as avg_time
+                FROM window_stats GROUP BY day
+                UNION ALL
+                SELECT 'difficulty', difficulty_level, SUM(questions), SUM(correct), NULL
+                FROM window_stats WHERE difficulty_level != -1 GROUP BY difficulty_level
+                UNION ALL
+                SELECT 'hourly', hour, SUM(questions), SUM(correct), NULL
+                FROM window_stats GROUP BY hour
+                ORDER BY kind, key
+            ''', (student_id, cutoff_day))
+            
+            daily_performance = []
+            difficulty_performance = []
+            hourly_performance = []
+            for kind, key, questions, correct, avg_time in cursor.fetchall():
+                if kind == 'daily':
+                    daily_performance.append({
+                        'date': key, 'questions': questions, 'correct': correct, 'avg_time': avg_time
+                    })
+                elif kind == 'difficulty':
+                    difficulty_performance.append({
+                        'difficulty_level': key, 'attempts': questions, 'success_rate': correct / questions
+                    })
+                else:
+                    hourly_performance.append({
+                        'hour': key, 'questions': questions, 'accuracy': correct / questions
+                    })
             
             return {
                 'analysis_period_days': days,
@@ -465,7 +875,7 @@ class SQLiteProgressTracker:
     
     def start_learning_session(self, student_id: str) -> int:
         """Start a new learning session and return session ID"""
-        with self.get_db_connection() as conn:
+        with self.write_transaction() as conn:
             cursor = conn.cursor()
             
             cursor.execute('''
@@ -474,48 +884,40 @@ class SQLiteProgressTracker:
             ''', (student_id,))
             
             session_id = cursor.lastrowid
-            conn.commit()
             return session_id
     
     def end_learning_session(self, session_id: int, topics_covered: List[str]) -> bool:
         """End a learning session and update statistics"""
-        with self.get_db_connection() as conn:
+        # The session's totals must include its still-queued interactions
+        self.flush()
+        with self.write_transaction() as conn:
             cursor = conn.cursor()
             
-            # Get session data
-            cursor.execute('''
-                SELECT student_id, session_start FROM learning_sessions 
-                WHERE id = ?
-            ''', (session_id,))
-            
-            session = cursor.fetchone()
-            if not session:
-                return False
-            
-            # Calculate session statistics
-            cursor.execute('''
-                SELECT COUNT(*) as questions,
-                       SUM(CASE WHEN success THEN 1 ELSE 0 END) as correct,
-                       SUM(time_taken) as total_time
-                FROM interactions 
-                WHERE student_id = ? AND timestamp >= ?
-            ''', (session['student_id'], session['session_start']))
-            
-            stats = cursor.fetchone()
-            
-            # Update session record
+            # Aggregate the session's interactions and close it in one
+            # statement; RETURNING reports whether the session exists
             cursor.execute('''
                 UPDATE learning_sessions 
                 SET session_end = CURRENT_TIMESTAMP,
                     topics_covered = ?,
-                    questions_attempted = ?,
-                    questions_correct = ?,
-                    total_time_minutes = ?
-                WHERE id = ?
-            ''', (json.dumps(topics_covered), stats['questions'], 
-                  stats['correct'], stats['total_time'], session_id))
-            
-            conn.commit()
+                    questions_attempted = stats.questions,
+                    questions_correct = stats.correct,
+                    total_time_minutes = stats.total_time
+                FROM (
+                    SELECT COUNT(*) as questions,
+                           COALESCE(SUM(CASE WHEN i.success THEN 1 ELSE 0 END), 0) as correct,
+                           COALESCE(SUM(i.time_taken), 0) as total_time
+                    FROM learning_sessions s
+                    JOIN interactions i
+                      ON i.student_id = s.student_id AND i.timestamp >= s.session_start
+                    WHERE s.id = ?
+                ) AS stats
+                WHERE learning_sessions.id = ?
+                RETURNING learning_sessions.id
+            ''', (orjson.dumps(topics_covered).decode(), session_id, session_id))
+            
+            if cursor.fetchone() is None:
+                return False
+            
             return True
 
 # Integration with the existing RAG system
@@ -554,7 +956,8 @@ class EnhancedEducationalRAG:
                                  question_text: str = None, user_answer: str = None):
         """Record student interaction with detailed tracking"""
         
-        return self.progress_tracker.record_interaction(
+        # Written in the background so the request doesn't wait on SQLite
+        return self.progress_tracker.enqueue_interaction(
             student_id=student_id,
             content_id=content_id,
             topic=topic,
@@ -1,16 +1,266 @@
+import os
+import asyncio
 import anthropic
-from typing import List, Dict, Any, Optional
+import httpx
+from typing import List, Dict, Any, Optional, Tuple
 import logging
+from types import MappingProxyType
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from utils.semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
+CLAUDE_MODEL = "claude-3-sonnet-20240229"
+
+# Rough characters per token of English text, used to keep the retrieved
+# context within a token budget without a tokenizer round trip
+CHARS_PER_TOKEN = 4
+
+# Shown in place of an answer when the Claude call fails; never cached
+CLAUDE_UNAVAILABLE_ANSWER = "I'm having trouble generating a response right now. Please try again."
+
+BOARD_INSTRUCTIONS = {
+    'CBSE': {
+        'style': 'Follow NCERT pattern with clear explanations and step-by-step solutions.',
+        'focus': 'Emphasize conceptual understanding and exam preparation.'
+    },
+    'ICSE': {
+        'style': 'Provide comprehensive explanations with multiple approaches.',
+        'focus': 'Include detailed reasoning and encourage analytical thinking.'
+    },
+    'SSC': {
+        'style': 'Use simple, direct explanations with local context where applicable.',
+        'focus': 'Focus on practical understanding and textbook methods.'
+    }
+}
+
+# (highest grade, instruction) ladder; None covers every grade above the last bound
+GRADE_INSTRUCTIONS = (
+    (5, """Use very simple language appropriate for young children (ages 8-11). 
+            - Use short sentences and familiar words
+            - Include fun examples and analogies
+            - Avoid complex mathematical terminology
+            - Make it engaging and easy to understand
+            - If a concept is too advanced, gently redirect to age-appropriate topics"""),
+    (8, """Use clear explanations appropriate for middle school students (ages 11-14).
+            - Use proper academic terminology but explain it clearly
+            - Include step-by-step explanations
+            - Provide relatable examples
+            - Build concepts gradually"""),
+    (None, """Use subject-appropriate terminology with detailed explanations for high school students.
+            - Include proper mathematical/scientific notation
+            - Provide comprehensive explanations
+            - Include advanced concepts where appropriate
+            - Prepare for board exams""")
+)
+
+def _grade_instruction(grade) -> str:
+    for max_grade, instruction in GRADE_INSTRUCTIONS:
+        if max_grade is None or grade <= max_grade:
+            return instruction
+
+@lru_cache(maxsize=128)
+def _system_prompt_frame(grade, board: str, language: str) -> Tuple[str, str]:
+    """
+    The system prompt text before and after the per-request content context.
+    
+    Everything here depends only on grade, board and language, so it is
+    formatted once per combination; only the retrieved methods, content
+    types and context are interpolated per request.
+    """
+    board_instruction = BOARD_INSTRUCTIONS.get(board, BOARD_INSTRUCTIONS['CBSE'])
+    grade_instruction = _grade_instruction(grade)
+    
+    head = f"""You are an expert educator for grade {grade} {board} board students.
+
+        CRITICAL GRADE APPROPRIATENESS RULES:
+        1. You are teaching a Grade {grade} student
+        2. If the content seems too advanced for Grade {grade}, simplify it significantly or mention it will be covered in higher grades
+        3. Never provide content that is clearly meant for much higher grades
+        4. Always match the cognitive development level of a Grade {grade} student
+        
+        BOARD-SPECIFIC APPROACH:
+        {board_instruction['style']}
+        {board_instruction['focus']}
+        
+        GRADE-APPROPRIATE LANGUAGE:
+        {grade_instruction}
+        
+        CONTENT CONTEXT:
+        """
+    tail = f"""        
+        IMPORTANT INSTRUCTIONS:
+        1. Base your response ONLY on the provided context
+        2. Use methods and approaches that match the student's grade {grade} and board {board}
+        3. If asked about methods not appropriate for Grade {grade}, mention they'll learn it in higher grades
+        4. Maintain consistency with the {board} board's teaching methodology for Grade {grade}
+        5. If content is in {language}, respond accordingly
+        6. NEVER provide advanced formulas or concepts inappropriate for Grade {grade}
+        7. If the question is about advanced topics, acknowledge their curiosity but redirect to grade-appropriate content
+        
+        Context (filtered for Grade {grade}):
+        """
+    return head, tail
+
+# Subtopic order and prerequisites per topic, used by generate_learning_path
+LEARNING_PROGRESSIONS = MappingProxyType({
+    'quadratic_equations': MappingProxyType({
+        'sequence': (
+            'patterns_introduction',
+            'factorization_method',
+            'completing_square',
+            'formula_method',
+            'applications'
+        ),
+        'prerequisites': MappingProxyType({
+            'patterns_introduction': (),
+            'factorization_method': ('patterns_introduction', 'basic_algebra'),
+            'completing_square': ('factorization_method', 'algebraic_manipulation'),
+            'formula_method': ('completing_square', 'square_roots'),
+            'applications': ('formula_method', 'word_problems')
+        })
+    }),
+    'digestive_system': MappingProxyType({
+        'sequence': (
+            'anatomy_structure',
+            'digestion_process',
+            'enzymes_secretions',
+            'absorption_transport',
+            'disorders_health'
+        ),
+        'prerequisites': MappingProxyType({
+            'anatomy_structure': (),
+            'digestion_process': ('anatomy_structure',),
+            'enzymes_secretions': ('digestion_process', 'basic_chemistry'),
+            'absorption_transport': ('anatomy_structure', 'cell_biology'),
+            'disorders_health': ('digestion_process', 'absorption_transport')
+        })
+    })
+})
+
+# Position of each subtopic within its topic's sequence
+SEQUENCE_POS = MappingProxyType({
+    topic: MappingProxyType({subtopic: i for i, subtopic in enumerate(progression['sequence'])})
+    for topic, progression in LEARNING_PROGRESSIONS.items()
+})
+
+# Follow-up questions per topic, subtopic and school level, offered when a
+# search finds no content; {grade} and {board} are filled in per request
+SUGGESTIONS = MappingProxyType({
+    'quadratic_equations': MappingProxyType({
+        'general': MappingProxyType({
+            'elementary': (
+                "What are square numbers? (better for Grade {grade})",
+                "How to recognize patterns in numbers?",
+                "What is multiplication?"
+            ),
+            'middle_school': (
+                "What are quadratic expressions for Grade {grade}?",
+                "How to factor simple expressions in {board}?",
+                "What is the difference between linear and quadratic?"
+            ),
+            'high_school': (
+                "What are the methods to solve quadratic equations in Grade {grade}?",
+                "Show me {board} board examples of quadratic equations",
+                "How do I identify which method to use?"
+            )
+        }),
+        'factorization_method': MappingProxyType({
+            'middle_school': (
+                "How do I factor simple expressions?",
+                "What is the splitting method for Grade 8?",
+                "When can I use simple factoring?"
+            ),
+            'high_school': (
+                "How do I factor x² + 5x + 6?",
+                "What is splitting the middle term?",
+                "When can I use simple factoring?"
+            )
+        }),
+        'formula_method': MappingProxyType({
+            'high_school': (
+                "What is the quadratic formula?",
+                "How do I use the discriminant?",
+                "Show me step-by-step formula application"
+            )
+        })
+    }),
+    'digestive_system': MappingProxyType({
+        'general': MappingProxyType({
+            'elementary': (
+                "What happens to food when we eat? (Grade {grade} level)",
+                "What are the main body parts for digestion?",
+                "Why do we need to chew our food?"
+            ),
+            'middle_school': (
+                "What parts of digestive system do we study in Grade {grade}?",
+                "How does digestion work for {board} board?",
+                "What are the main digestive organs?"
+            ),
+            'high_school': (
+                "Explain detailed digestion process for Grade {grade} {board}",
+                "What are digestive enzymes?",
+                "How does absorption work in small intestine?"
+            )
+        })
+    })
+})
+
+@lru_cache(maxsize=512)
+def _alternative_suggestions(topic: str, subtopic: str, grade, board: str) -> Tuple[str, ...]:
+    """Formatted SUGGESTIONS for a topic, subtopic, grade and board."""
+    if grade <= 5:
+        level = 'elementary'
+    elif grade <= 8:
+        level = 'middle_school'
+    else:
+        level = 'high_school'
+    
+    topic_suggestions = SUGGESTIONS.get(topic, {})
+    if subtopic in topic_suggestions:
+        templates = topic_suggestions[subtopic].get(level, topic_suggestions['general'].get(level, ()))
+    else:
+        templates = topic_suggestions.get('general', {}).get(level, ())
+    return tuple(template.format(grade=grade, board=board) for template in templates)
+
+def normalize_faq_question(question: str) -> str:
+    """Case-, whitespace- and end-punctuation-insensitive form of a question."""
+    return ' '.join(question.lower().split()).rstrip('?!. ')
+
+def response_events(response: Dict):
+    """Stream events for an already complete answer payload."""
+    answer = response.get("answer", "")
+    yield {"type": "metadata", **{key: value for key, value in response.items() if key != "answer"}}
+    if answer:
+        yield {"type": "delta", "text": answer}
+    yield {"type": "done", "answer": answer}
+
 class EducationalRAG:
-    def __init__(self, anthropic_api_key: str, vector_stores: Dict[str, Any], embedding_model):
+    def __init__(self, anthropic_api_key: str, vector_stores: Dict[str, Any], embedding_model,
+                 response_cache: Optional[SemanticCache] = None, batch_workers: int = 4,
+                 faqs: Optional[List[Dict]] = None, context_token_budget: int = 3000):
         """Initialize the Educational RAG system with multiple vector stores."""
         self.anthropic_api_key = anthropic_api_key
         self.vector_stores = vector_stores
         self.embedding_model = embedding_model
-        self.client = anthropic.Anthropic(api_key=anthropic_api_key)
+        self.response_cache = response_cache
+        # Prompt input tokens drive Claude's latency and cost; lower-ranked
+        # results past this many context tokens are cut
+        self.context_token_budget = context_token_budget
+        # Curated answers to well-known questions, served before any embedding,
+        # search or Claude call: (topic, normalized question) -> entries
+        self.faqs = {}
+        for entry in faqs or []:
+            key = (entry['topic'], normalize_faq_question(entry['question']))
+            self.faqs.setdefault(key, []).append(entry)
+        self.client = self._create_client()
+        # answer_many overlaps the Pinecone and Claude round trips of a batch
+        self.batch_workers = batch_workers
+        self._executor = ThreadPoolExecutor(max_workers=batch_workers, thread_name_prefix='rag-batch')
+        # A forked worker must not share the parent's pooled sockets or threads
+        os.register_at_fork(after_in_child=self._reset_client)
+        os.register_at_fork(after_in_child=self._reset_executor)
         
         self.topic_index_map = {
             'quadratic_equations': ('math_index', 'algebra_quadratic_equations'),
@@ -33,71 +283,270 @@ class EducationalRAG:
     def answer_educational_question(self, question: str, topic: str, metadata_filter: Dict, level: str = None):
         """Answer a question with comprehensive metadata filtering and grade appropriateness."""
         try:
-            if topic not in self.topic_index_map:
+            index_entry = self.topic_index_map.get(topic)
+            if index_entry is None:
                 return {
                     "answer": f"Topic {topic} not found in the system.",
                     "error": "Invalid topic"
                 }
             
-            index_name, namespace = self.topic_index_map[topic]
-            vector_store = self.vector_stores[index_name]
+            faq_response = self._faq_response(question, topic, metadata_filter)
+            if faq_response:
+                return faq_response
+            
+            cache_key = SemanticCache.make_filter_key(topic, metadata_filter, level)
+            if self.response_cache:
+                cached = self.response_cache.get_exact(question, cache_key)
+                if cached:
+                    return cached
             
             query_embedding = self.embedding_model.embed_query(question)
+            return self._answer_with_embedding(question, topic, index_entry, metadata_filter, cache_key, query_embedding)
             
-            results = vector_store.similarity_search(
-                query_embedding,
-                namespace=namespace,
-                top_k=5,
-                filter=metadata_filter
-            )
+        except Exception as e:
+            logger.error(f"Error answering question: {str(e)}")
+            return {
+                "answer": "I encountered an error while generating a response. Please try again.",
+                "error": str(e)
+            }
+    
+    def answer_many(self, questions: List[Tuple[str, str, Dict, Optional[str]]]) -> List[Dict]:
+        """
+        Answer several questions, embedding all of them in one model call and
+        running their searches and Claude calls concurrently (cache hits are
+        served inline). Repeats of the same question with the same topic,
+        level and filter within the batch are answered once.
+        
+        Args:
+            questions: (question, topic, metadata_filter, level) tuples
             
-            if not results:
-                relaxed_filter = {
-                    'board': metadata_filter.get('board'),
-                    'grade': metadata_filter.get('grade')
+        Returns:
+            One response per question, in the same order
+        """
+        responses: List[Optional[Dict]] = [None] * len(questions)
+        pending = []
+        first_index = {}
+        duplicates = []
+        
+        for i, (question, topic, metadata_filter, level) in enumerate(questions):
+            index_entry = self.topic_index_map.get(topic)
+            if index_entry is None:
+                responses[i] = {
+                    "answer": f"Topic {topic} not found in the system.",
+                    "error": "Invalid topic"
                 }
-                results = vector_store.similarity_search(
-                    query_embedding,
-                    namespace=namespace,
-                    top_k=5,
-                    filter=relaxed_filter
-                )
+                continue
             
-            if not results:
+            faq_response = self._faq_response(question, topic, metadata_filter)
+            if faq_response:
+                responses[i] = faq_response
+                continue
+            
+            cache_key = SemanticCache.make_filter_key(topic, metadata_filter, level)
+            if (question, cache_key) in first_index:
+                duplicates.append((i, first_index[question, cache_key]))
+                continue
+            first_index[question, cache_key] = i
+            
+            cached = self.response_cache.get_exact(question, cache_key) if self.response_cache else None
+            if cached:
+                responses[i] = cached
+            else:
+                pending.append((i, index_entry, cache_key))
+        
+        if pending:
+            try:
+                embeddings = self.embedding_model.embed_queries([questions[i][0] for i, _, _ in pending])
+            except Exception as e:
+                logger.error(f"Error embedding questions: {str(e)}")
+                for i, _, _ in pending:
+                    responses[i] = self._error_response(e)
+                pending, embeddings = [], []
+            
+            def answer(item):
+                (i, index_entry, cache_key), query_embedding = item
+                question, topic, metadata_filter, _ = questions[i]
+                try:
+                    return self._answer_with_embedding(question, topic, index_entry, metadata_filter,
+                                                       cache_key, query_embedding)
+                except Exception as e:
+                    logger.error(f"Error answering question: {str(e)}")
+                    return self._error_response(e)
+            
+            for (i, _, _), response in zip(pending, self._executor.map(answer, zip(pending, embeddings))):
+                responses[i] = response
+        
+        for i, first in duplicates:
+            responses[i] = dict(responses[first])
+        
+        return responses
+    
+    @staticmethod
+    def _error_response(error: Exception) -> Dict:
+        return {
+            "answer": "I encountered an error while generating a response. Please try again.",
+            "error": str(error)
+        }
+    
+    def _faq_response(self, question: str, topic: str, metadata_filter: Dict) -> Optional[Dict]:
+        """Curated answer for a well-known question, if one fits the student's grade."""
+        if not self.faqs:
+            return None
+        entries = self.faqs.get((topic, normalize_faq_question(question)))
+        if not entries:
+            return None
+        
+        grade = metadata_filter.get('grade')
+        for entry in entries:
+            grades = entry.get('grades')
+            if not grades or grade in grades:
                 return {
-                    "answer": f"I couldn't find relevant content for your query with the specified filters.",
-                    "metadata_filter": metadata_filter,
-                    "suggestions": self._get_alternative_suggestions(topic, metadata_filter)
+                    "answer": entry['answer'],
+                    "source": "faq_fast_path",
+                    "filter_applied": metadata_filter,
+                    "topic": topic
                 }
+        return None
+    
+    def _answer_with_embedding(self, question: str, topic: str, index_entry: Tuple[str, str],
+                               metadata_filter: Dict, cache_key, query_embedding: List[float]) -> Dict:
+        """Answer a question whose embedding is already known, past the exact-match cache tier."""
+        if self.response_cache:
+            cached = self.response_cache.get_similar(query_embedding, cache_key, question)
+            if cached:
+                return cached
+        
+        index_name, namespace = index_entry
+        vector_store = self.vector_stores[index_name]
+        
+        results = self._search_with_fallback(vector_store, query_embedding, namespace, metadata_filter)
+        
+        response = self._answer_from_results(question, topic, metadata_filter, results)
+        self._cache_response(question, query_embedding, cache_key, response)
+        return response
+    
+    def answer_educational_question_stream(self, question: str, topic: str, metadata_filter: Dict, level: str = None):
+        """
+        Streaming variant of answer_educational_question.
+        
+        Yields event dicts: one 'metadata' event, 'delta' events carrying answer
+        text as Claude produces it, then a 'done' event with the full answer.
+        """
+        try:
+            index_entry = self.topic_index_map.get(topic)
+            if index_entry is None:
+                yield from response_events({
+                    "answer": f"Topic {topic} not found in the system.",
+                    "error": "Invalid topic"
+                })
+                return
             
-            # Build context from results
-            context_parts = []
-            content_metadata = []
+            faq_response = self._faq_response(question, topic, metadata_filter)
+            if faq_response:
+                yield from response_events(faq_response)
+                return
             
-            for result in results:
-                context_parts.append(result.get('text', ''))
-                content_metadata.append({
-                    'content_id': result.get('content_id'),
-                    'subtopic': result.get('subtopic'),
-                    'sub_method': result.get('sub_method'),
-                    'method_tags': result.get('method_tags', []),
-                    'difficulty_level': result.get('difficulty_level'),
-                    'content_type': result.get('content_type')
-                })
+            cache_key = SemanticCache.make_filter_key(topic, metadata_filter, level)
+            if self.response_cache:
+                cached = self.response_cache.get_exact(question, cache_key)
+                if cached:
+                    yield from response_events(cached)
+                    return
             
-            context = "\n\n".join(context_parts)
+            index_name, namespace = index_entry
+            vector_store = self.vector_stores[index_name]
             
-            response = self._generate_educational_response(
-                question, context, metadata_filter, content_metadata
-            )
+            query_embedding = self.embedding_model.embed_query(question)
             
-            return {
-                "answer": response,
+            if self.response_cache:
+                cached = self.response_cache.get_similar(query_embedding, cache_key, question)
+                if cached:
+                    yield from response_events(cached)
+                    return
+            
+            results = self._search_with_fallback(vector_store, query_embedding, namespace, metadata_filter)
+            
+            if not results:
+                yield from response_events(self._no_results_response(topic, metadata_filter))
+                return
+            
+            context, content_metadata = self._build_context(results)
+            metadata = {
                 "content_metadata": content_metadata,
                 "filter_applied": metadata_filter,
                 "topic": topic,
                 "results_count": len(results)
             }
+            yield {"type": "metadata", **metadata}
+            
+            request = self._build_claude_request(question, context, metadata_filter, content_metadata)
+            answer_parts = []
+            try:
+                with self.client.messages.stream(**request) as stream:
+                    for text in stream.text_stream:
+                        answer_parts.append(text)
+                        yield {"type": "delta", "text": text}
+            except Exception as e:
+                logger.error(f"Error calling Claude: {str(e)}")
+                fallback = CLAUDE_UNAVAILABLE_ANSWER
+                yield {"type": "delta", "text": fallback}
+                yield {"type": "done", "answer": "".join(answer_parts) + fallback}
+                return
+            
+            answer = "".join(answer_parts)
+            self._cache_response(question, query_embedding, cache_key, {"answer": answer, **metadata})
+            yield {"type": "done", "answer": answer}
+            
+        except Exception as e:
+            logger.error(f"Error streaming answer: {str(e)}")
+            yield {"type": "error", "error": str(e)}
+    
+    async def answer_educational_question_async(self, question: str, topic: str, metadata_filter: Dict, level: str = None):
+        """Async variant of answer_educational_question that overlaps Pinecone and Claude I/O."""
+        try:
+            index_entry = self.topic_index_map.get(topic)
+            if index_entry is None:
+                return {
+                    "answer": f"Topic {topic} not found in the system.",
+                    "error": "Invalid topic"
+                }
+            
+            faq_response = self._faq_response(question, topic, metadata_filter)
+            if faq_response:
+                return faq_response
+            
+            cache_key = SemanticCache.make_filter_key(topic, metadata_filter, level)
+            if self.response_cache:
+                cached = self.response_cache.get_exact(question, cache_key)
+                if cached:
+                    return cached
+            
+            index_name, namespace = index_entry
+            vector_store = self.vector_stores[index_name]
+            
+            query_embedding = await asyncio.to_thread(self.embedding_model.embed_query, question)
+            
+            if self.response_cache:
+                cached = self.response_cache.get_similar(query_embedding, cache_key, question)
+                if cached:
+                    return cached
+            
+            results = await asyncio.to_thread(
+                self._search_with_fallback, vector_store, query_embedding, namespace, metadata_filter
+            )
+            
+            if not results:
+                return self._no_results_response(topic, metadata_filter)
+            
+            context, content_metadata = self._build_context(results)
+            
+            answer = await self._generate_educational_response_async(
+                question, context, metadata_filter, content_metadata
+            )
+            
+            response = self._answer_response(answer, topic, metadata_filter, content_metadata, results)
+            self._cache_response(question, query_embedding, cache_key, response)
+            return response
             
         except Exception as e:
             logger.error(f"Error answering question: {str(e)}")
@@ -106,6 +555,120 @@ class EducationalRAG:
                 "error": str(e)
             }
     
+    def _answer_from_results(self, question: str, topic: str, metadata_filter: Dict, results: List[Dict]):
+        """Turn similarity-search results into an answer payload."""
+        if not results:
+            return self._no_results_response(topic, metadata_filter)
+        
+        context, content_metadata = self._build_context(results)
+        
+        answer = self._generate_educational_response(
+            question, context, metadata_filter, content_metadata
+        )
+        
+        return self._answer_response(answer, topic, metadata_filter, content_metadata, results)
+    
+    @staticmethod
+    def _answer_response(answer: Optional[str], topic: str, metadata_filter: Dict,
+                         content_metadata: List[Dict], results: List[Dict]) -> Dict:
+        """
+        Answer payload. A failed Claude call (None) gets the fallback text and
+        an 'error' key, which keeps it out of the response cache.
+        """
+        response = {
+            "answer": answer if answer is not None else CLAUDE_UNAVAILABLE_ANSWER,
+            "content_metadata": content_metadata,
+            "filter_applied": metadata_filter,
+            "topic": topic,
+            "results_count": len(results)
+        }
+        if answer is None:
+            response["error"] = "Claude request failed"
+        return response
+    
+    def _search(self, vector_store, query_embedding: List[float], namespace: str,
+                top_k: int, metadata_filter: Dict) -> List[Dict]:
+        """
+        Similarity search using a request-level metadata filter.
+        
+        Each chunk is stored once with the list of grades it applies to, so a
+        'grade' filter is translated into a membership test on 'grades' and the
+        matching grade's difficulty is resolved on the returned results.
+        """
+        grade = metadata_filter.get('grade')
+        index_filter = {key: value for key, value in metadata_filter.items() if key != 'grade'}
+        if grade is not None:
+            grade_key = str(grade)
+            index_filter['grades'] = {'$in': [grade_key]}
+        
+        results = vector_store.similarity_search(
+            query_embedding,
+            namespace=namespace,
+            top_k=top_k,
+            filter=index_filter
+        )
+        
+        if grade is not None:
+            for result in results:
+                grades = result.get('grades') or []
+                difficulty_levels = result.get('difficulty_levels') or []
+                if grade_key in grades and len(difficulty_levels) == len(grades):
+                    result['grade'] = grade
+                    result['difficulty_level'] = float(difficulty_levels[grades.index(grade_key)])
+        
+        return results
+    
+    def _search_with_fallback(self, vector_store, query_embedding: List[float], namespace: str,
+                              metadata_filter: Dict) -> List[Dict]:
+        """Search with the full filter, relaxing to board and grade only if nothing matches."""
+        results = self._search(vector_store, query_embedding, namespace, 5, metadata_filter)
+        
+        if not results:
+            relaxed_filter = {
+                'board': metadata_filter.get('board'),
+                'grade': metadata_filter.get('grade')
+            }
+            results = self._search(vector_store, query_embedding, namespace, 5, relaxed_filter)
+        
+        return results
+    
+    def _cache_response(self, question: str, query_embedding: List[float], cache_key, response: Dict):
+        """Cache answers that were grounded in retrieved content."""
+        if self.response_cache and response.get('content_metadata') and 'error' not in response:
+            self.response_cache.put(question, query_embedding, cache_key, response)
+    
+    def _no_results_response(self, topic: str, metadata_filter: Dict):
+        return {
+            "answer": f"I couldn't find relevant content for your query with the specified filters.",
+            "metadata_filter": metadata_filter,
+            "suggestions": self._get_alternative_suggestions(topic, metadata_filter)
+        }
+    
+    def _build_context(self, results: List[Dict]):
+        """Build the prompt context and per-result metadata from search results."""
+        context_parts = []
+        content_metadata = []
+        budget = self.context_token_budget * CHARS_PER_TOKEN
+        
+        # Results arrive best match first, so the budget truncates the last
+        # one it reaches and drops everything ranked below it
+        for result in results:
+            if budget <= 0:
+                break
+            text = result.get('text', '')[:budget]
+            budget -= len(text)
+            context_parts.append(text)
+            content_metadata.append({
+                'content_id': result.get('content_id'),
+                'subtopic': result.get('subtopic'),
+                'sub_method': result.get('sub_method'),
+                'method_tags': result.get('method_tags', []),
+                'difficulty_level': result.get('difficulty_level'),
+                'content_type': result.get('content_type')
+            })
+        
+        return "\n\n".join(context_parts), content_metadata
+    
     def get_adaptive_content(self, topic: str, metadata_filter: Dict):
         """Get content adapted to student's current level."""
         try:
@@ -115,31 +678,30 @@ class EducationalRAG:
             query = f"Practice problems for {topic} at difficulty level {metadata_filter.get('difficulty_level', 3)}"
             query_embedding = self.embedding_model.embed_query(query)
             
-            results = vector_store.similarity_search(
-                query_embedding,
-                namespace=namespace,
-                top_k=10,
-                filter=metadata_filter
-            )
+            results = self._search(vector_store, query_embedding, namespace, 10, metadata_filter)
             
             sorted_results = sorted(
                 results,
                 key=lambda x: (x.get('difficulty_level', 3), -0.5)
             )
             
-            selected_content = []
-            content_types_seen = set()
-            
+            # The easiest result of each content type first, then the easiest
+            # of the rest until five are chosen
+            first_by_type = {}
             for result in sorted_results:
-                content_type = result.get('content_type')
-                if content_type not in content_types_seen or len(selected_content) < 5:
-                    selected_content.append(result)
-                    content_types_seen.add(content_type)
+                first_by_type.setdefault(result.get('content_type'), result)
+            selected_content = list(first_by_type.values())[:5]
+            if len(selected_content) < 5:
+                chosen = {id(result) for result in selected_content}
+                selected_content += [
+                    result for result in sorted_results if id(result) not in chosen
+                ][:5 - len(selected_content)]
+            content_types_seen = list(first_by_type)
             
             return {
-                "adaptive_content": selected_content[:5],
+                "adaptive_content": selected_content,
                 "difficulty_range": metadata_filter.get('difficulty_level'),
-                "content_types": list(content_types_seen)
+                "content_types": content_types_seen
             }
             
         except Exception as e:
@@ -149,48 +711,11 @@ class EducationalRAG:
     def generate_learning_path(self, topic: str, grade: int, board: str, current_subtopic: str = None, mastery_level: float = 0.5):
         """Generate a personalized learning path based on current progress."""
         try:
-            learning_progressions = {
-                'quadratic_equations': {
-                    'sequence': [
-                        'patterns_introduction',
-                        'factorization_method',
-                        'completing_square',
-                        'formula_method',
-                        'applications'
-                    ],
-                    'prerequisites': {
-                        'patterns_introduction': [],
-                        'factorization_method': ['patterns_introduction', 'basic_algebra'],
-                        'completing_square': ['factorization_method', 'algebraic_manipulation'],
-                        'formula_method': ['completing_square', 'square_roots'],
-                        'applications': ['formula_method', 'word_problems']
-                    }
-                },
-                'digestive_system': {
-                    'sequence': [
-                        'anatomy_structure',
-                        'digestion_process',
-                        'enzymes_secretions',
-                        'absorption_transport',
-                        'disorders_health'
-                    ],
-                    'prerequisites': {
-                        'anatomy_structure': [],
-                        'digestion_process': ['anatomy_structure'],
-                        'enzymes_secretions': ['digestion_process', 'basic_chemistry'],
-                        'absorption_transport': ['anatomy_structure', 'cell_biology'],
-                        'disorders_health': ['digestion_process', 'absorption_transport']
-                    }
-                }
-            }
-            
-            progression = learning_progressions.get(topic, {})
+            progression = LEARNING_PROGRESSIONS.get(topic, {})
             sequence = progression.get('sequence', [])
             prerequisites = progression.get('prerequisites', {})
             
-            current_index = 0
-            if current_subtopic and current_subtopic in sequence:
-                current_index = sequence.index(current_subtopic)
+            current_index = SEQUENCE_POS.get(topic, {}).get(current_subtopic, 0)
             
             learning_path = {
                 'current_subtopic': current_subtopic or sequence[0],
@@ -217,7 +742,7 @@ class EducationalRAG:
                         {
                             'subtopic': next_subtopic,
                             'focus': 'introduction',
-                            'prerequisites_to_review': prerequisites.get(next_subtopic, [])
+                            'prerequisites_to_review': list(prerequisites.get(next_subtopic, ()))
                         }
                     ]
                 else:
@@ -231,9 +756,9 @@ class EducationalRAG:
                     ]
             
             if mastery_level < 0.4:
-                prereqs = prerequisites.get(current_subtopic, [])
+                prereqs = prerequisites.get(current_subtopic, ())
                 if prereqs:
-                    learning_path['remediation'] = prereqs
+                    learning_path['remediation'] = list(prereqs)
             
             return learning_path
             
@@ -241,9 +766,29 @@ class EducationalRAG:
             logger.error(f"Error generating learning path: {str(e)}")
             return {"error": str(e)}
     
-    def _generate_educational_response(self, question: str, context: str, 
-                                     metadata_filter: Dict, content_metadata: List[Dict]):
-        """Generate a response with awareness of content metadata and grade appropriateness."""
+    def _create_client(self):
+        """
+        One keep-alive pool per process so Claude calls skip the TLS handshake;
+        over HTTP/2, concurrent calls (answer_many, threaded workers) share a
+        connection as multiplexed streams instead of each opening their own.
+        """
+        return anthropic.Anthropic(
+            api_key=self.anthropic_api_key,
+            http_client=anthropic.DefaultHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=120)
+            )
+        )
+    
+    def _reset_client(self):
+        self.client = self._create_client()
+    
+    def _reset_executor(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.batch_workers, thread_name_prefix='rag-batch')
+    
+    def _build_claude_request(self, question: str, context: str,
+                              metadata_filter: Dict, content_metadata: List[Dict]):
+        """Build the Claude messages request for an educational answer."""
         
         grade = metadata_filter.get('grade', 9)
         board = metadata_filter.get('board', 'CBSE')
@@ -255,74 +800,13 @@ class EducationalRAG:
             all_methods.update(meta.get('method_tags', []))
             content_types.add(meta.get('content_type', 'general'))
         
-        instruction_map = {
-            'CBSE': {
-                'style': 'Follow NCERT pattern with clear explanations and step-by-step solutions.',
-                'focus': 'Emphasize conceptual understanding and exam preparation.'
-            },
-            'ICSE': {
-                'style': 'Provide comprehensive explanations with multiple approaches.',
-                'focus': 'Include detailed reasoning and encourage analytical thinking.'
-            },
-            'SSC': {
-                'style': 'Use simple, direct explanations with local context where applicable.',
-                'focus': 'Focus on practical understanding and textbook methods.'
-            }
-        }
-        
-        board_instruction = instruction_map.get(board, instruction_map['CBSE'])
-        
-        if grade <= 5:
-            grade_instruction = """Use very simple language appropriate for young children (ages 8-11). 
-            - Use short sentences and familiar words
-            - Include fun examples and analogies
-            - Avoid complex mathematical terminology
-            - Make it engaging and easy to understand
-            - If a concept is too advanced, gently redirect to age-appropriate topics"""
-        elif grade <= 8:
-            grade_instruction = """Use clear explanations appropriate for middle school students (ages 11-14).
-            - Use proper academic terminology but explain it clearly
-            - Include step-by-step explanations
-            - Provide relatable examples
-            - Build concepts gradually"""
-        else:
-            grade_instruction = """Use subject-appropriate terminology with detailed explanations for high school students.
-            - Include proper mathematical/scientific notation
-            - Provide comprehensive explanations
-            - Include advanced concepts where appropriate
-            - Prepare for board exams"""
-        
-        system_prompt = f"""You are an expert educator for grade {grade} {board} board students.
-
-        CRITICAL GRADE APPROPRIATENESS RULES:
-        1. You are teaching a Grade {grade} student
-        2. If the content seems too advanced for Grade {grade}, simplify it significantly or mention it will be covered in higher grades
-        3. Never provide content that is clearly meant for much higher grades
-        4. Always match the cognitive development level of a Grade {grade} student
-        
-        BOARD-SPECIFIC APPROACH:
-        {board_instruction['style']}
-        {board_instruction['focus']}
-        
-        GRADE-APPROPRIATE LANGUAGE:
-        {grade_instruction}
-        
-        CONTENT CONTEXT:
-        Available methods in the content: {', '.join(all_methods) if all_methods else 'general explanation'}
-        Content types available: {', '.join(content_types)}
-        
-        IMPORTANT INSTRUCTIONS:
-        1. Base your response ONLY on the provided context
-        2. Use methods and approaches that match the student's grade {grade} and board {board}
-        3. If asked about methods not appropriate for Grade {grade}, mention they'll learn it in higher grades
-        4. Maintain consistency with the {board} board's teaching methodology for Grade {grade}
-        5. If content is in {language}, respond accordingly
-        6. NEVER provide advanced formulas or concepts inappropriate for Grade {grade}
-        7. If the question is about advanced topics, acknowledge their curiosity but redirect to grade-appropriate content
-        
-        Context (filtered for Grade {grade}):
-        {context}
-        """
+        # Sorted so the same retrieved content always yields the same prompt
+        # prefix, which is what lets Claude's prompt cache match it
+        head, tail = _system_prompt_frame(grade, board, language)
+        system_prompt = (
+            f"{head}Available methods in the content: {', '.join(sorted(all_methods)) if all_methods else 'general explanation'}\n"
+            f"        Content types available: {', '.join(sorted(content_types, key=str))}\n{tail}{context}\n        "
+        )
         
         messages = [
             {
@@ -331,96 +815,53 @@ class EducationalRAG:
             }
         ]
         
+        return {
+            "model": CLAUDE_MODEL,
+            # Follow-up and repeated questions usually retrieve the same context;
+            # a cache breakpoint lets Claude reuse the prefill of the whole
+            # system prompt for five minutes instead of reprocessing it
+            "system": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}],
+            "messages": messages,
+            "max_tokens": 1000,
+            "temperature": 0.7
+        }
+    
+    def _generate_educational_response(self, question: str, context: str, 
+                                     metadata_filter: Dict, content_metadata: List[Dict]) -> Optional[str]:
+        """Generate a response with awareness of content metadata and grade appropriateness (None if Claude fails)."""
+        request = self._build_claude_request(question, context, metadata_filter, content_metadata)
+        
         try:
-            response = self.client.messages.create(
-                model="claude-3-sonnet-20240229",
-                system=system_prompt,
-                messages=messages,
-                max_tokens=1000,
-                temperature=0.7
-            )
+            response = self.client.messages.create(**request)
+            
+            return response.content[0].text
+            
+        except Exception as e:
+            logger.error(f"Error calling Claude: {str(e)}")
+            return None
+    
+    async def _generate_educational_response_async(self, question: str, context: str,
+                                                   metadata_filter: Dict, content_metadata: List[Dict]) -> Optional[str]:
+        """Async counterpart of _generate_educational_response."""
+        request = self._build_claude_request(question, context, metadata_filter, content_metadata)
+        
+        try:
+            # Flask runs each async view in its own event loop, so an async
+            # client could not keep connections alive across requests; the
+            # pooled sync client in a worker thread can
+            response = await asyncio.to_thread(self.client.messages.create, **request)
             
             return response.content[0].text
             
         except Exception as e:
             logger.error(f"Error calling Claude: {str(e)}")
-            return "I'm having trouble generating a response right now. Please try again."
+            return None
     
     def _get_alternative_suggestions(self, topic: str, metadata_filter: Dict):
         """Get alternative suggestions based on current filters and grade level."""
-        grade = metadata_filter.get('grade', 9)
-        board = metadata_filter.get('board', 'CBSE')
-        subtopic = metadata_filter.get('subtopic', '')
-        
-        suggestions = {
-            'quadratic_equations': {
-                'general': {
-                    'elementary': [
-                        f"What are square numbers? (better for Grade {grade})",
-                        f"How to recognize patterns in numbers?",
-                        "What is multiplication?"
-                    ],
-                    'middle_school': [
-                        f"What are quadratic expressions for Grade {grade}?",
-                        f"How to factor simple expressions in {board}?",
-                        "What is the difference between linear and quadratic?"
-                    ],
-                    'high_school': [
-                        f"What are the methods to solve quadratic equations in Grade {grade}?",
-                        f"Show me {board} board examples of quadratic equations",
-                        "How do I identify which method to use?"
-                    ]
-                },
-                'factorization_method': {
-                    'middle_school': [
-                        "How do I factor simple expressions?",
-                        "What is the splitting method for Grade 8?",
-                        "When can I use simple factoring?"
-                    ],
-                    'high_school': [
-                        "How do I factor x² + 5x + 6?",
-                        "What is splitting the middle term?",
-                        "When can I use simple factoring?"
-                    ]
-                },
-                'formula_method': {
-                    'high_school': [
-                        "What is the quadratic formula?",
-                        "How do I use the discriminant?",
-                        "Show me step-by-step formula application"
-                    ]
-                }
-            },
-            'digestive_system': {
-                'general': {
-                    'elementary': [
-                        f"What happens to food when we eat? (Grade {grade} level)",
-                        f"What are the main body parts for digestion?",
-                        "Why do we need to chew our food?"
-                    ],
-                    'middle_school': [
-                        f"What parts of digestive system do we study in Grade {grade}?",
-                        f"How does digestion work for {board} board?",
-                        "What are the main digestive organs?"
-                    ],
-                    'high_school': [
-                        f"Explain detailed digestion process for Grade {grade} {board}",
-                        "What are digestive enzymes?",
-                        "How does absorption work in small intestine?"
-                    ]
-                }
-            }
-        }
-        
-        if grade <= 5:
-            level = 'elementary'
-        elif grade <= 8:
-            level = 'middle_school'
-        else:
-            level = 'high_school'
-        
-        topic_suggestions = suggestions.get(topic, {})
-        if subtopic in topic_suggestions:
-            return topic_suggestions[subtopic].get(level, topic_suggestions['general'].get(level, []))
-        else:
-            return topic_suggestions.get('general', {}).get(level, [])
\ No newline at end of file
+        return list(_alternative_suggestions(
+            topic,
+            metadata_filter.get('subtopic', ''),
+            metadata_filter.get('grade', 9),
+            metadata_filter.get('board', 'CBSE')
+        ))
\ No newline at end of file
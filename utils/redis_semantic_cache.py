@@ -0,0 +1,163 @@
+import json
+import hashlib
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+import redis
+
+from utils.semantic_cache import SemanticCache
+
+logger = logging.getLogger(__name__)
+
+class RedisSemanticCache(SemanticCache):
+    def __init__(self, redis_url: str, dimension: int, similarity_threshold: float = 0.95,
+                 ttl_seconds: int = 86400, index_name: str = 'idx:qa', prefix: str = 'qa'):
+        """
+        Semantic answer cache shared by every worker process through Redis.
+
+        Question embeddings live in hashes indexed by a RediSearch HNSW vector
+        index and the answers under separate keys; both share a TTL that is
+        refreshed on every hit, so stale entries age out of the index without
+        rebuilding it. A vector whose answer is gone is skipped and deleted.
+        Vectors are tagged with their filter and the question's numbers, so a
+        lookup only ranks questions whose answer could apply.
+
+        Args:
+            redis_url: Redis Stack connection URL
+            dimension: Embedding dimension of the vector index
+            similarity_threshold: Minimum cosine similarity for a semantic hit
+            ttl_seconds: Lifetime of a cached answer since its last hit
+            index_name: Name of the RediSearch index
+            prefix: Key prefix for cached vectors and answers
+        """
+        self.similarity_threshold = similarity_threshold
+        self.dimension = dimension
+        self.ttl_seconds = ttl_seconds
+        self.index_name = index_name
+        self.vector_prefix = f'{prefix}:vec:'
+        self.response_prefix = f'{prefix}:resp:'
+        # Nearest neighbours fetched per lookup, so a dead vector doesn't hide a live one
+        self.knn_candidates = 3
+
+        self.redis = redis.Redis.from_url(redis_url)
+        self._create_index()
+
+    def _create_index(self):
+        """Create the HNSW vector index unless another worker already did."""
+        try:
+            self.redis.execute_command(
+                'FT.CREATE', self.index_name, 'ON', 'HASH', 'PREFIX', 1, self.vector_prefix,
+                'SCHEMA',
+                'filter', 'TAG',
+                'embedding', 'VECTOR', 'HNSW', 6,
+                'TYPE', 'FLOAT32', 'DIM', self.dimension, 'DISTANCE_METRIC', 'COSINE'
+            )
+            logger.info(f"Created Redis vector index {self.index_name}")
+        except redis.ResponseError as e:
+            if 'already exists' not in str(e).lower():
+                raise
+
+    @staticmethod
+    def _filter_tag(filter_key: Tuple) -> str:
+        """Stable, tag-safe digest of a filter key (hash() differs between processes)."""
+        return hashlib.sha1(json.dumps(filter_key).encode('utf-8')).hexdigest()
+
+    def _entry_id(self, question: str, filter_key: Tuple) -> str:
+        key = f'{self._normalize_question(question)}\x00{self._filter_tag(filter_key)}'
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _get_response(self, entry_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch an answer and push its and its vector's expiry back."""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.getex(self.response_prefix + entry_id, ex=self.ttl_seconds)
+        pipe.expire(self.vector_prefix + entry_id, self.ttl_seconds)
+        payload, _ = pipe.execute()
+        if payload is None:
+            return None
+        return json.loads(payload)
+
+    def get_exact(self, question: str, filter_key: Tuple) -> Optional[Dict[str, Any]]:
+        """Return a cached answer for exactly this question and filter, if any."""
+        try:
+            return self._get_response(self._entry_id(question, filter_key))
+        except redis.RedisError as e:
+            logger.error(f"Error reading Redis cache: {str(e)}")
+            return None
+
+    def get_similar(self, query_embedding: List[float], filter_key: Tuple,
+                    question: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached answer whose question embedding is most similar, if
+        above threshold (and, with question given, has the same numbers).
+        """
+        query = self._unit_vector(query_embedding)
+        if query is None or query.shape[0] != self.dimension:
+            return None
+        filter_key = self._semantic_key(filter_key, question)
+
+        try:
+            result = self.redis.execute_command(
+                'FT.SEARCH', self.index_name,
+                f'(@filter:{{{self._filter_tag(filter_key)}}})=>[KNN {self.knn_candidates} @embedding $vec AS score]',
+                'PARAMS', 2, 'vec', query.tobytes(),
+                'RETURN', 1, 'score',
+                'SORTBY', 'score',
+                'LIMIT', 0, self.knn_candidates,
+                'DIALECT', 2
+            )
+            if not result:
+                return None
+
+            # Nearest first; a vector can outlive its answer (evicted under
+            # memory pressure, or expired between the two keys' TTLs), so
+            # such entries are dropped and the next candidate tried
+            for key, fields in zip(result[1::2], result[2::2]):
+                fields = dict(zip(fields[::2], fields[1::2]))
+                # COSINE reports a distance; convert back to similarity
+                similarity = 1.0 - float(fields[b'score'])
+                if similarity < self.similarity_threshold:
+                    return None
+
+                response = self._get_response(key.decode('utf-8')[len(self.vector_prefix):])
+                if response is not None:
+                    logger.info(f"Semantic cache hit (similarity {similarity:.3f})")
+                    return response
+                self.redis.delete(key)
+        except redis.RedisError as e:
+            logger.error(f"Error searching Redis cache: {str(e)}")
+        return None
+
+    def put(self, question: str, query_embedding: List[float], filter_key: Tuple, response: Dict[str, Any]):
+        """Store an answer and, when the embedding is usable, its vector."""
+        entry_id = self._entry_id(question, filter_key)
+        query = self._unit_vector(query_embedding)
+
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(self.response_prefix + entry_id, json.dumps(response), ex=self.ttl_seconds)
+            if query is not None and query.shape[0] == self.dimension:
+                pipe.hset(self.vector_prefix + entry_id, mapping={
+                    'filter': self._filter_tag(self._semantic_key(filter_key, question)),
+                    'embedding': query.tobytes()
+                })
+                pipe.expire(self.vector_prefix + entry_id, self.ttl_seconds)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"Error writing Redis cache: {str(e)}")
+
+    def clear(self):
+        """Drop all cached answers and vectors."""
+        try:
+            self.redis.execute_command('FT.DROPINDEX', self.index_name, 'DD')
+            for key in self.redis.scan_iter(match=self.response_prefix + '*'):
+                self.redis.delete(key)
+        except redis.RedisError as e:
+            logger.error(f"Error clearing Redis cache: {str(e)}")
+        self._create_index()
+
+    def save(self, path: str) -> bool:
+        """Redis persists the cache itself."""
+        return True
+
+    def load(self, path: str) -> bool:
+        """Redis persists the cache itself."""
+        return False
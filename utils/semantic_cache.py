@@ -0,0 +1,224 @@
+import os
+import re
+import json
+import threading
+import logging
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Numbers and operators in a question. Near matches must agree on them
+# exactly: "solve x^2 - 5x + 6 = 0" and "solve x^2 - 5x + 8 = 0" differ by one
+# character and embed almost identically, but have different answers
+_QUERY_NUMBERS_RE = re.compile(r'\d+(?:\.\d+)?|[-+*/^=<>%×÷√]')
+
+def query_numbers(text: str) -> Tuple[str, ...]:
+    """The numbers and operators in text, in order."""
+    return tuple(_QUERY_NUMBERS_RE.findall(text))
+
+class SemanticCache:
+    def __init__(self, max_entries: int = 1024, similarity_threshold: float = 0.95):
+        """
+        Two-tier cache of RAG answers.
+
+        The exact tier is an LRU keyed on the normalized question text; the
+        semantic tier returns a cached answer when a new question's embedding
+        is within the cosine-similarity threshold of a cached one asked with
+        the same topic, level and metadata filter, and the same numbers.
+
+        Args:
+            max_entries: Maximum number of answers kept in each tier
+            similarity_threshold: Minimum cosine similarity for a semantic hit
+        """
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+
+        self._lock = threading.Lock()
+        self._exact = OrderedDict()
+
+        # Ring buffer of normalized query embeddings, filter-key hashes and answers
+        self._embeddings = None
+        self._filter_hashes = np.zeros(max_entries, dtype=np.int64)
+        self._filter_keys: List[Optional[Tuple]] = [None] * max_entries
+        self._responses: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        self._size = 0
+        self._next_slot = 0
+
+    @staticmethod
+    def make_filter_key(topic: str, metadata_filter: Dict, level: str = None) -> Tuple:
+        """Hashable key for everything besides the question that shapes an answer."""
+        return (topic, level, tuple(sorted((key, repr(value)) for key, value in metadata_filter.items())))
+
+    @staticmethod
+    def _semantic_key(filter_key: Tuple, question: Optional[str]) -> Tuple:
+        """Key semantic-tier entries are matched within: the filter, plus the question's numbers."""
+        if question is None:
+            return filter_key
+        return (filter_key, query_numbers(question))
+
+    @staticmethod
+    def _normalize_question(question: str) -> str:
+        return ' '.join(question.lower().split())
+
+    def get_exact(self, question: str, filter_key: Tuple) -> Optional[Dict[str, Any]]:
+        """Return a cached answer for exactly this question and filter, if any."""
+        key = (self._normalize_question(question), filter_key)
+        with self._lock:
+            response = self._exact.get(key)
+            if response is None:
+                return None
+            self._exact.move_to_end(key)
+        return dict(response)
+
+    def get_similar(self, query_embedding: List[float], filter_key: Tuple,
+                    question: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached answer whose question embedding is most similar, if
+        above threshold. With question given, only answers cached for a
+        question with the same numbers and operators are considered.
+        """
+        query = self._unit_vector(query_embedding)
+        if query is None:
+            return None
+        filter_key = self._semantic_key(filter_key, question)
+
+        with self._lock:
+            if self._size == 0 or self._embeddings.shape[1] != query.shape[0]:
+                return None
+
+            similarities = self._embeddings[:self._size] @ query
+            similarities[self._filter_hashes[:self._size] != hash(filter_key)] = -1.0
+
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            response = self._responses[best]
+
+        logger.info(f"Semantic cache hit (similarity {similarities[best]:.3f})")
+        return dict(response)
+
+    def put(self, question: Optional[str], query_embedding: List[float], filter_key: Tuple, response: Dict[str, Any]):
+        """Store an answer in both cache tiers (only the semantic tier when question is None)."""
+        query = self._unit_vector(query_embedding)
+
+        semantic_key = self._semantic_key(filter_key, question)
+
+        with self._lock:
+            if question is not None:
+                key = (self._normalize_question(question), filter_key)
+                self._exact[key] = dict(response)
+                self._exact.move_to_end(key)
+                if len(self._exact) > self.max_entries:
+                    self._exact.popitem(last=False)
+
+            if query is None:
+                return
+
+            if self._embeddings is None or self._embeddings.shape[1] != query.shape[0]:
+                self._embeddings = np.zeros((self.max_entries, query.shape[0]), dtype=np.float32)
+                self._size = 0
+                self._next_slot = 0
+
+            slot = self._next_slot
+            self._embeddings[slot] = query
+            self._filter_hashes[slot] = hash(semantic_key)
+            self._filter_keys[slot] = semantic_key
+            self._responses[slot] = dict(response)
+            self._next_slot = (slot + 1) % self.max_entries
+            self._size = min(self._size + 1, self.max_entries)
+
+    def clear(self):
+        """Drop all cached answers."""
+        with self._lock:
+            self._exact.clear()
+            self._embeddings = None
+            self._filter_keys = [None] * self.max_entries
+            self._responses = [None] * self.max_entries
+            self._size = 0
+            self._next_slot = 0
+
+    def save(self, path: str) -> bool:
+        """
+        Persist both cache tiers so a restarted process starts warm.
+
+        Args:
+            path: Destination .npz file
+        """
+        try:
+            with self._lock:
+                slots = [(self._next_slot - self._size + i) % self.max_entries for i in range(self._size)]
+                state = {
+                    'exact': [[question, filter_key, response]
+                              for (question, filter_key), response in self._exact.items()],
+                    'semantic': [[self._filter_keys[slot], self._responses[slot]] for slot in slots]
+                }
+                embeddings = self._embeddings[slots] if slots else np.zeros((0, 0), dtype=np.float32)
+
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Every worker saves at exit; write-then-rename keeps the file whole
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                np.savez(f, embeddings=embeddings, state=np.array(json.dumps(state)))
+            os.replace(temp_path, path)
+            logger.info(f"Saved {len(state['exact'])} cached answers to {path}")
+            return True
+        except Exception as e:
+            logger.error(f"Error saving semantic cache: {str(e)}")
+            return False
+
+    def load(self, path: str) -> bool:
+        """
+        Restore cache tiers previously written by save().
+
+        Args:
+            path: Source .npz file
+        """
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with np.load(path) as data:
+                embeddings = data['embeddings']
+                state = json.loads(str(data['state']))
+
+            with self._lock:
+                for question, filter_key, response in state['exact'][-self.max_entries:]:
+                    self._exact[(question, self._as_key(filter_key))] = response
+
+                for embedding, (filter_key, response) in zip(embeddings[-self.max_entries:],
+                                                             state['semantic'][-self.max_entries:]):
+                    filter_key = self._as_key(filter_key)
+                    if self._embeddings is None:
+                        self._embeddings = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+                    slot = self._next_slot
+                    self._embeddings[slot] = embedding
+                    self._filter_hashes[slot] = hash(filter_key)
+                    self._filter_keys[slot] = filter_key
+                    self._responses[slot] = response
+                    self._next_slot = (slot + 1) % self.max_entries
+                    self._size = min(self._size + 1, self.max_entries)
+
+            logger.info(f"Loaded {len(self._exact)} cached answers from {path}")
+            return True
+        except Exception as e:
+            logger.error(f"Error loading semantic cache: {str(e)}")
+            return False
+
+    @classmethod
+    def _as_key(cls, value):
+        """Rebuild the nested tuples of a filter key decoded from JSON lists."""
+        if isinstance(value, list):
+            return tuple(cls._as_key(item) for item in value)
+        return value
+
+    @staticmethod
+    def _unit_vector(embedding: List[float]) -> Optional[np.ndarray]:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
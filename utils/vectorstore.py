@@ -1,13 +1,24 @@
 import os
 import logging
+import threading
 from typing import List, Dict, Any, Optional
+import numpy as np
 from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import NotFoundException
 import time
+from utils.semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
+# Holds one marker vector per ingested namespace, away from searchable content
+FINGERPRINT_NAMESPACE = '__fingerprints__'
+
+# Index names already found or created with the right dimension in this process
+_CHECKED_INDEXES = set()
+
 class VectorStore:
-    def __init__(self, api_key: str, environment: str, index_name: str, dimension: int = 384):
+    def __init__(self, api_key: str, environment: str, index_name: str, dimension: int = 384,
+                 pool_threads: int = 30, result_cache: Optional[SemanticCache] = None):
         """
         Initialize Pinecone vector store.
         
@@ -16,39 +27,73 @@ class VectorStore:
             environment: Pinecone environment (e.g., "us-east-1-aws", "gcp-starter")
             index_name: Name of the Pinecone index
             dimension: Dimension of embeddings (default: 384 for all-MiniLM-L6-v2)
+            pool_threads: Number of threads used for parallel (async_req) upserts
+            result_cache: Optional cache returning stored matches for near-identical queries
         """
         self.api_key = api_key
         self.environment = environment
         self.index_name = index_name
         self.dimension = dimension
+        self.pool_threads = pool_threads
+        self.result_cache = result_cache
+        
+        # Creating the client is local; the control-plane calls that find,
+        # check or create the index wait for the first data-plane operation
+        self.pc = Pinecone(api_key=api_key)
+        self._index = None
+        self._index_lock = threading.Lock()
+        # A forked worker gets its own connection pool and upsert threads
+        os.register_at_fork(after_in_child=self._reconnect)
+    
+    @property
+    def index(self):
+        """Data-plane handle for the index, connected on first use."""
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    self._ensure_index()
+                    self._index = self.pc.Index(self.index_name, pool_threads=self.pool_threads)
+                    logger.info(f"Connected to Pinecone index: {self.index_name}")
+        return self._index
+    
+    def _ensure_index(self):
+        """Create the index, or recreate it on a dimension mismatch, once per process."""
+        if self.index_name in _CHECKED_INDEXES:
+            return
         
         try:
-            self.pc = Pinecone(api_key=api_key)
-            
-            existing_indexes = self.pc.list_indexes().names()
+            # One describe_index round trip both finds the index and checks
+            # its dimension; listing every index first would add another
+            try:
+                index_info = self.pc.describe_index(self.index_name)
+            except NotFoundException:
+                index_info = None
             
-            if index_name in existing_indexes:
-                logger.info(f"Found existing index: {index_name}")
+            if index_info is not None:
+                logger.info(f"Found existing index: {self.index_name}")
                 
-                index_info = self.pc.describe_index(index_name)
                 existing_dimension = index_info.dimension
                 
-                if existing_dimension != dimension:
-                    logger.warning(f"Index dimension mismatch. Expected: {dimension}, Found: {existing_dimension}")
+                if existing_dimension != self.dimension:
+                    logger.warning(f"Index dimension mismatch. Expected: {self.dimension}, Found: {existing_dimension}")
                     logger.warning("Deleting and recreating index with correct dimensions...")
-                    self.pc.delete_index(index_name)
+                    self.pc.delete_index(self.index_name)
                     time.sleep(5)
                     self._create_index()
             else:
                 self._create_index()
             
-            self.index = self.pc.Index(index_name)
-            logger.info(f"Connected to Pinecone index: {index_name}")
+            _CHECKED_INDEXES.add(self.index_name)
             
         except Exception as e:
             logger.error(f"Failed to initialize Pinecone: {str(e)}")
             raise
     
+    def _reconnect(self):
+        self._index_lock = threading.Lock()
+        if self._index is not None:
+            self._index = self.pc.Index(self.index_name, pool_threads=self.pool_threads)
+    
     def _create_index(self):
         """Create a new Pinecone index."""
         try:
@@ -99,44 +144,61 @@ class VectorStore:
             batch_size: Number of vectors to upsert at once
         """
         try:
-            vectors = []
-            
+            valid = []
             for i, doc in enumerate(documents):
                 if 'embedding' not in doc:
                     logger.warning(f"Document {i} missing embedding, skipping")
                     continue
-                
-                vector_id = f"{namespace}_{i}_{hash(doc.get('text', ''))}"
-                
-                metadata = {k: v for k, v in doc.items() if k != 'embedding'}
-                
-                for key, value in metadata.items():
-                    if isinstance(value, (list, dict)):
-                        metadata[key] = str(value)
-                
-                vector = {
-                    "id": vector_id,
-                    "values": doc["embedding"],
-                    "metadata": metadata
+                valid.append((i, doc))
+            
+            # Stack every embedding into one float32 matrix and convert it to
+            # the plain float lists the Pinecone client expects in one call
+            values = np.asarray([doc['embedding'] for _, doc in valid], dtype=np.float32).tolist()
+            
+            vectors = [
+                {
+                    # Prefer the chunk's unique content_id so ids stay unique across add_documents calls
+                    "id": doc.get('content_id') or f"{namespace}_{i}_{hash(doc.get('text', ''))}",
+                    "values": vector_values,
+                    "metadata": self._pinecone_metadata(doc)
                 }
-                vectors.append(vector)
+                for (i, doc), vector_values in zip(valid, values)
+            ]
             
             if not vectors:
                 logger.warning("No valid vectors to add")
                 return False
             
-            for i in range(0, len(vectors), batch_size):
-                batch = vectors[i:i + batch_size]
-                self.index.upsert(vectors=batch, namespace=namespace)
-                logger.info(f"Upserted batch {i//batch_size + 1}/{(len(vectors)-1)//batch_size + 1}")
+            # Fire all batches concurrently on the index thread pool, then wait for them
+            async_results = [
+                self.index.upsert(vectors=vectors[i:i + batch_size], namespace=namespace, async_req=True)
+                for i in range(0, len(vectors), batch_size)
+            ]
+            for batch_number, async_result in enumerate(async_results, start=1):
+                async_result.get()
+                logger.info(f"Upserted batch {batch_number}/{len(async_results)}")
             
             logger.info(f"Successfully added {len(vectors)} vectors to namespace '{namespace}'")
+            if self.result_cache:
+                self.result_cache.clear()
             return True
             
         except Exception as e:
             logger.error(f"Error adding documents to Pinecone: {str(e)}")
             return False
     
+    @staticmethod
+    def _pinecone_metadata(doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Document fields besides the embedding, as Pinecone metadata values."""
+        # Pinecone metadata supports lists of strings natively; anything else is stringified
+        return {
+            key: str(value) if isinstance(value, dict) or (
+                isinstance(value, list) and not all(isinstance(item, str) for item in value)
+            ) else value
+            for key, value in doc.items()
+            if key != 'embedding'
+        }
+    
     def similarity_search(self, query_embedding: List[float], namespace: str, 
                          top_k: int = 5, filter: Optional[Dict] = None):
         """
@@ -152,6 +214,13 @@ class VectorStore:
             List of matching documents with their metadata and scores
         """
         try:
+            cache_key = SemanticCache.make_filter_key(namespace, filter or {}, str(top_k))
+            if self.result_cache:
+                cached = self.result_cache.get_similar(query_embedding, cache_key)
+                if cached:
+                    # Callers annotate matches in place, so hand out copies
+                    return [dict(match) for match in cached['matches']]
+            
             query_params = {
                 "namespace": namespace,
                 "vector": query_embedding,
@@ -165,15 +234,17 @@ class VectorStore:
             
             results = self.index.query(**query_params)
             
-            matches = []
-            for match in results.matches:
-                if match.metadata:
-                    item = dict(match.metadata)
-                    item['score'] = match.score
-                    item['id'] = match.id
-                    matches.append(item)
+            # Copies, so the SDK's own metadata dicts are never mutated
+            matches = [
+                {**match.metadata, 'score': match.score, 'id': match.id}
+                for match in results.matches
+                if match.metadata
+            ]
             
             logger.info(f"Found {len(matches)} matches in namespace '{namespace}' with filter {filter}")
+            if self.result_cache and matches:
+                self.result_cache.put(None, query_embedding, cache_key,
+                                      {'matches': [dict(match) for match in matches]})
             return matches
             
         except Exception as e:
@@ -232,6 +303,56 @@ class VectorStore:
             logger.error(f"Error getting namespace stats: {str(e)}")
             return {}
     
+    def get_fingerprint(self, namespace: str) -> Optional[str]:
+        """
+        Get the fingerprint recorded after the last complete ingestion of a namespace.
+        
+        Args:
+            namespace: Namespace the fingerprint belongs to
+            
+        Returns:
+            Fingerprint string, or None if the namespace was never fully ingested
+            
+        Raises:
+            Exception: if the fetch fails, so a lookup error isn't mistaken for
+            a namespace that was never ingested
+        """
+        try:
+            fetch_result = self.index.fetch(ids=[namespace], namespace=FINGERPRINT_NAMESPACE)
+            vector = fetch_result.vectors.get(namespace)
+            if vector and vector.metadata:
+                return vector.metadata.get('fingerprint')
+            return None
+            
+        except Exception as e:
+            logger.error(f"Error fetching fingerprint: {str(e)}")
+            raise
+    
+    def set_fingerprint(self, namespace: str, fingerprint: str):
+        """
+        Record the fingerprint of a namespace's ingested content.
+        
+        Args:
+            namespace: Namespace the fingerprint belongs to
+            fingerprint: Hash of the ingested content
+        """
+        try:
+            # Pinecone rejects all-zero dense vectors
+            self.index.upsert(
+                vectors=[{
+                    "id": namespace,
+                    "values": [1.0] + [0.0] * (self.dimension - 1),
+                    "metadata": {"fingerprint": fingerprint}
+                }],
+                namespace=FINGERPRINT_NAMESPACE
+            )
+            logger.info(f"Recorded fingerprint for namespace '{namespace}'")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error recording fingerprint: {str(e)}")
+            return False
+    
     def delete_namespace(self, namespace: str):
         """
         Delete all vectors in a namespace.
@@ -241,6 +362,8 @@ class VectorStore:
         """
         try:
             self.index.delete(delete_all=True, namespace=namespace)
+            if self.result_cache:
+                self.result_cache.clear()
             logger.info(f"Deleted namespace '{namespace}'")
             return True
             
@@ -275,6 +398,8 @@ class VectorStore:
                 namespace=namespace
             )
             
+            if self.result_cache:
+                self.result_cache.clear()
             logger.info(f"Updated metadata for vector {vector_id}")
             return True
             